@@ -1,169 +1,234 @@
 import argparse
-import collections
-import pickle
-from scipy import spatial
-import sys
+import concurrent.futures
+from scipy import stats
 import os
-from numpy import average
 import numpy
 
+import interaction_store
+from interaction_store import InteractionStore
+from theano_bpr.utils import load_evaluation
+
 IMPRESSION = 0
+SPLIT_STRATEGIES = ('last_click', 'last_n', 'time_cutoff')
+
+
+def _group_starts(keys):
+    '''
+    :return: start positions of the runs of equal values in `keys`
+    '''
+    return numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+
+
+def split_masks(users, items, interactions, timestamps, strategy='last_click', n=1, cutoff=None):
+    '''
+    Decides for every event whether it goes to train, to test or nowhere.
+    The columns must be sorted by (user, timestamp), `users` holding user positions.
+        last_click: the last non impression event on an item not impressed before it is the test
+                    event, every earlier event of that user is train
+        last_n: the last `n` non impression events of a user are test, every earlier event is train
+        time_cutoff: non impression events from `cutoff` on are test, events before `cutoff` are train
+    Users without a test event get no train events either, except for time_cutoff.
+    :return: (train, test) boolean masks over the events
+    '''
+    n_events = len(users)
+    positions = numpy.arange(n_events)
+    clicks = interactions != IMPRESSION
+    if n_events == 0:
+        return clicks, clicks
+    starts = _group_starts(users)
+    user_of = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.r_[starts, n_events]))
+
+    if strategy == 'time_cutoff':
+        return timestamps < cutoff, clicks & (timestamps >= cutoff)
+
+    if strategy == 'last_click':
+        # impressions of the same (user, item) seen before every event
+        order = numpy.lexsort((positions, items, users))
+        impressions = (~clicks[order]).astype(numpy.int64)
+        seen = numpy.cumsum(impressions) - impressions
+        pair_starts = _group_starts(users[order] * (int(items.max()) + 1) + items[order])
+        seen -= numpy.repeat(seen[pair_starts], numpy.diff(numpy.r_[pair_starts, n_events]))
+        impressed_before = numpy.empty(n_events, dtype=bool)
+        impressed_before[order] = seen > 0
+
+        last = numpy.maximum.reduceat(numpy.where(clicks & ~impressed_before, positions, -1), starts)
+        test = positions == last[user_of]
+        first_test = last
+    elif strategy == 'last_n':
+        clicks_left = numpy.cumsum(clicks[::-1].astype(numpy.int64))[::-1]
+        user_ends = numpy.r_[starts[1:], n_events]
+        clicks_left -= numpy.r_[clicks_left[user_ends[:-1]], 0][user_of]
+        test = clicks & (clicks_left <= n)
+        first_test = numpy.minimum.reduceat(numpy.where(test, positions, n_events), starts)
+        first_test[first_test == n_events] = -1
+    else:
+        raise ValueError("unknown split strategy %s, expected one of %s" % (strategy, SPLIT_STRATEGIES))
+
+    train = positions < first_test[user_of]
+    return train, test
+
+
+def _split_shard(shard):
+    '''
+    Splits one shard of whole users.
+    :return: (train, test) arrays of unique (user, item) rows
+    '''
+    users, user_ids, items, interactions, timestamps, options = shard
+    train, test = split_masks(users, items, interactions, timestamps, **options)
+    return tuple(
+        numpy.unique(numpy.column_stack((user_ids[users[mask]], items[mask])), axis=0)
+        for mask in (train, test)
+    )
+
+
+def cosine_similarity(x, scores):
+    '''
+    :return: cosine similarity between the vector `x` and every column of `scores`
+    '''
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return x.dot(scores) / (numpy.linalg.norm(x) * numpy.linalg.norm(scores, axis=0))
+
+
+def pearson_correlation(x, scores):
+    '''
+    :return: Pearson correlation between the vector `x` and every column of `scores`
+    '''
+    return cosine_similarity(x - x.mean(), scores - scores.mean(axis=0))
+
+
+def spearman_correlation(x, scores):
+    '''
+    :return: Spearman rank correlation between the vector `x` and every column of `scores`
+    '''
+    return pearson_correlation(stats.rankdata(x), stats.rankdata(scores, axis=0))
+
 
 class RecSys:
-    interactions_db = {}
-    interactions_db2 = {}
+    interactions = None
     positive_feedback = {1, 2, 3}
     evaluation_results = {}
-    ctr_results = {}
+    ctr_results = None
 
-    def __init__(self, lines):
+    def __init__(self, in_file, cache_dir='interactions_cache'):
         '''
-        Goal of this function is to store hash table of all data together, in the following formats:
-            interactions_db[user][item][interaction_type][timestamp] = 1
-            interactions_db2[user][timestamp] = (item,  interaction)
-        :param lines: list of all usage-points with the pattern 'user item interaction'
+        Goal of this function is to store all data together in a columnar InteractionStore:
+            user, item, interaction and timestamp columns sorted by (user, timestamp)
+            offsets[k]:offsets[k + 1] is the slice of events of the k-th user
+        The store is cached in `cache_dir` and rebuilt whenever `in_file` changes.
+        :param in_file: path of all usage-points with the pattern 'user item interaction timestamp'
+        :param cache_dir: directory of the binary interactions cache
         '''
-        #
-        count = 0
-        interactions_db = {}
-        interactions_db2 = {}
-        try:
-            # we try to load hash table from a pickled file
-            print("Loading DB from pickled .txt files")
-            with open('interactions.txt', 'rb') as handle:
-                self.interactions_db = pickle.loads(handle.read())
-            with open('interactions2.txt', 'rb') as handle:
-                self.interactions_db2 = pickle.loads(handle.read())
-            print("Loaded DB from .txt files")
-            return
-        except:
-            print("%s: Didn't manage to load DB from .txt files, keeping the regular flow" % sys.exc_info()[0])
-            self.interactions_db = {}
-            self.interactions_db2  = {}
-
-        for line in lines:
-            count += 1
+        self.interactions = interaction_store.load_cached(in_file, cache_dir, self._parse)
+        print('done loading interaction store, found %s elements' % self.interactions.n_users)
 
-            # skip header
-            if count is 1:
-                continue
-
-            tokens = line.split()
-            user, item, interaction, timestamp = int(tokens[0]), int(tokens[1]), int(tokens[2]), int(tokens[3])
-
-            if user not in interactions_db.keys():
-                interactions_db[user] = {item: {interaction: {timestamp: 1}}}
-            elif item not in interactions_db[user].keys():
-                interactions_db[user][item] = {interaction: {timestamp: 1}}
-            elif interaction not in interactions_db[user][item].keys():
-                interactions_db[user][item][interaction] = {timestamp: 1}
-            elif timestamp not in interactions_db[user][item][interaction].keys():
-                interactions_db[user][item][interaction][timestamp] = 1
-
-            if user not in interactions_db2.keys():
-                interactions_db2[user] = {}
-            interactions_db2[user][timestamp] = (item,  interaction)
-
-            if count % 10000 == 0:
-                print(count)
-
-        print('done parsing from file to dictionary, found %s elements'% len(interactions_db))
-        self.interactions_db = interactions_db
-        self.interactions_db2 = interactions_db2
-        with open('interactions.txt', 'wb') as handle:
-            pickle.dump(interactions_db, handle)
-        with open('interactions2.txt', 'wb') as handle:
-            pickle.dump(interactions_db2, handle)
+    @staticmethod
+    def _parse(in_file):
+        return InteractionStore.from_file(in_file)
 
     def CTR(self):
+        '''
+        CTR of a user is the share of its impressed items that also got a positive feedback.
+        Computed for all users at once over the unique (user, item) pairs of the store.
+        '''
         print("Calculating CTR")
-        CTR_res = {}
-
-        def CTRu(user):
-            numerator = 0
-            denominator = 0
-
-            for item in self.interactions_db[user]:
-                if 0 in self.interactions_db[user][item].keys():
-                    denominator += 1 if len(self.interactions_db[user][item][0]) > 0 else 0
-                    numerator += 1 if len(
-                        set(self.interactions_db[user][item].keys()) & self.positive_feedback) > 0 else 0
-            return float(numerator) / denominator if denominator is not 0 else 0
-
-        for user, value in self.interactions_db.items():
-            CTR_res[user] = CTRu(user)
-        f = open("userCTR", 'w')
-        for user in CTR_res.keys():
-            f.write(str(user) + " " + str(CTR_res[user]) + "\n")
-        f.close()
-        print("found %d users for CTR" % len(CTR_res))
-        self.ctr_results = CTR_res
+        db = self.interactions
+        users, items, masks = db.pair_masks()
+        positive_mask = sum(1 << interaction for interaction in self.positive_feedback)
+
+        impressed = (masks & (1 << IMPRESSION)) != 0
+        clicked = impressed & ((masks & positive_mask) != 0)
+        denominator = numpy.bincount(users, weights=impressed, minlength=db.n_users)
+        numerator = numpy.bincount(users, weights=clicked, minlength=db.n_users)
+        ctr = numpy.zeros(db.n_users)
+        numpy.divide(numerator, denominator, out=ctr, where=denominator > 0)
+
+        numpy.savetxt("userCTR", numpy.column_stack((db.user_ids, ctr)), fmt=['%d', '%.12g'])
+        print("found %d users for CTR" % db.n_users)
+        self.ctr_results = (numpy.asarray(db.user_ids, dtype=numpy.int64), ctr)
+
+    def aligned_matrix(self):
+        '''
+        Joins CTR and all evaluation methods on their mutual users.
+        :return: (users, ctr, methods, scores) where scores is a users x methods matrix
+                 and ctr[k], scores[k, :] belong to users[k]
+        '''
+        methods = sorted(self.evaluation_results)
+        # Collect the mutual users list between all algorithms and CTR, all of them sorted by user
+        users = self.ctr_results[0]
+        for method in methods:
+            users = numpy.intersect1d(users, self.evaluation_results[method][0], assume_unique=True)
+        print("Found %d mutual users between algorithms" % len(users))
+
+        def align(results):
+            result_users, values = results
+            return values[numpy.searchsorted(result_users, users)]
+
+        scores = numpy.empty((len(users), len(methods)))
+        for j, method in enumerate(methods):
+            scores[:, j] = align(self.evaluation_results[method])
+        return users, align(self.ctr_results), methods, scores
 
     def clear_ctr_output(self):
         print('Removing non intersecting users from DB')
-        users = []
-        # Collect the mutual users list between all algorithms
-        for method in self.evaluation_results:
-            if len(users) == 0:  # first one
-                users = set(self.evaluation_results[method].keys())
-            else:
-                users &= set(self.evaluation_results[method].keys())
-        users &= set(self.ctr_results.keys())
-        print("Found %d mutual users between algorithms" % len(users))
+        users, ctr, methods, scores = self.aligned_matrix()
 
-        # Remove the non existing users from all evaluation methods results
-        tmp_dict = {}
-        for method in self.evaluation_results:
-            tmp_dict[method] = {}
-            for user in users:
-                tmp_dict[method][user] = self.evaluation_results[method][user]
-        self.evaluation_results = tmp_dict
-
-        # Remove the non existing users from CTR results
-        tmp_ctr_dict = {}
-        for user in users:
-            tmp_ctr_dict[user] = self.ctr_results[user]
-        self.ctr_results = tmp_ctr_dict
-
-    def ALGS(self, evaluations_dir):
+        # Remove the non existing users from all evaluation methods results and CTR results
+        for j, method in enumerate(methods):
+            self.evaluation_results[method] = (users, scores[:, j])
+        self.ctr_results = (users, ctr)
+
+    def ALGS(self, evaluations_dir, n_threads=8):
         """
-        go over all algorithm outputs and put them in
+        go over all algorithm outputs and put them in evaluation_results as sorted (users, scores) arrays
+        a text output with a binary .npz sidecar next to it is read from the sidecar
         :return:
         """
-        for filename in os.listdir(evaluations_dir):
-            if filename.endswith('_Store'):
+        paths = {}
+        filenames = set(os.listdir(evaluations_dir))
+        for filename in sorted(filenames):
+            if filename.endswith('_Store') or filename + '.npz' in filenames:
                 continue
+            method = filename[:-len('.npz')] if filename.endswith('.npz') else filename
+            paths[method] = evaluations_dir + '/' + filename
             print("Fetching %s Evaluation data" % filename)
-            algFile = open(evaluations_dir + '/' + filename, 'r')
-            lines = algFile.read().splitlines()
-            algFile.close()
-            alg_evaluation = {}
-            for line in lines:
-                tokens = line.split()
-                user = int(tokens[0])
-                evaluation = float(tokens[1])
-                alg_evaluation[user] = evaluation
-            self.evaluation_results[filename] = collections.OrderedDict(sorted(alg_evaluation.items()))
-            print("found %d users for %s" % (len(self.evaluation_results[filename]), filename))
+
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            evaluations = executor.map(load_evaluation, paths.values())
+            for method, evaluation in zip(paths, evaluations):
+                self.evaluation_results[method] = evaluation
+                print("found %d users for %s" % (len(evaluation[0]), method))
 
     def __getattribute__(self, *args, **kwargs):
         return super().__getattribute__(*args, **kwargs)
 
+    def calculate_similarities(self, measure):
+        users, ctr, methods, scores = self.aligned_matrix()
+        return dict(zip(methods, measure(ctr, scores).tolist()))
+
     def calculate_pierson_similarity(self):
         """
-        Calculates the cosine similarity between CTR and the evaluation methods
-        :return: cosine similarity between CTR and each of evaluation methods
+        Calculates the Pearson correlation between CTR and the evaluation methods
+        :return: absolute Pearson correlation between CTR and each of evaluation methods
         """
-        print("calculating cosine similarity between ctr and all other evaluation methods")
+        print("calculating Pearson correlation between ctr and all other evaluation methods")
 
-        self.clear_ctr_output()
-
-        similarity = {}
-        for method in self.evaluation_results:
-            similarity[method] = abs(numpy.corrcoef(list(self.ctr_results.values()), list(self.evaluation_results[method].values()))[1, 0])
+        similarity = {method: abs(value) for method, value in self.calculate_similarities(pearson_correlation).items()}
+        for method in similarity:
             print("Pierson similarity between CTR and %s is %f" % (method, similarity[method]))
         return similarity
 
+    def calculate_spearman_similarity(self):
+        """
+        Calculates the Spearman rank correlation between CTR and the evaluation methods
+        :return: Spearman correlation between CTR and each of evaluation methods
+        """
+        print("calculating Spearman correlation between ctr and all other evaluation methods")
+
+        similarity = self.calculate_similarities(spearman_correlation)
+        for method in similarity:
+            print("Spearman similarity between CTR and %s is %f" % (method, similarity[method]))
+        return similarity
+
     def calculate_cosine_similarity(self):
         """
         Calculates the cosine similarity between CTR and the evaluation methods
@@ -171,71 +236,58 @@ class RecSys:
         """
         print("calculating cosine similarity between ctr and all other evaluation methods")
 
-        self.clear_ctr_output()
-
-        similarity = {}
-
-        for method in self.evaluation_results:
-            xavg = average(list(self.ctr_results.values()))
-            yavg = average(list(self.evaluation_results[method].values()))
-            #print("CTR avg %f" % xavg)
-            #print("evaluation avg %f" % yavg)
-            xval = numpy.array(list(self.ctr_results.values()))
-            yval = numpy.array(list(self.evaluation_results[method].values()))
-            similarity[method] = 1 - spatial.distance.cosine(xval, yval)
+        similarity = self.calculate_similarities(cosine_similarity)
+        for method in similarity:
             print("Cosine similarity between CTR and %s is %f" % (method, similarity[method]))
         return similarity
 
-    def splitData(self, train_filename, test_filename):
+    def splitData(self, train_filename, test_filename, strategy='last_click', n=1, cutoff=None, n_jobs=1):
+        '''
+        Splits the interactions to "user item" train and test files, see split_masks for the strategies.
+        Users are sharded in `n_jobs` contiguous blocks of similar event counts (a user is never cut),
+        split in a process pool.
+        '''
         print("splitting data to train and test")
 
-        testItems = []
-        trainItems = []
         if (os.path.isfile(train_filename) and  os.path.isfile(test_filename)):
             return
-        trainFile = open(train_filename, 'w')
-        testFile = open(test_filename, 'w')
-        for user in self.interactions_db2:
-            impressed_item = {}
-            od = collections.OrderedDict(sorted(self.interactions_db2[user].items()))
-            last = None
-
-            # find the last interaction that is not impression
-            for element in od:
-                item = od[element][0]
-                timestamp = element
-                interaction = od[element][1]
-
-                if interaction == IMPRESSION:
-                    impressed_item[item] = 1
-
-                if interaction is not IMPRESSION and item not in impressed_item.keys():
-                    # if interaction is not impression & we didn't see an impression of this item so far - put in test
-                    last = timestamp
-
-            if (last is  None):
-                continue  # if we didn't find item
-
-            # Put right tuples in trainItems and testItems
-            for element in od:
-                item = od[element][0]
-                timestamp = element
-
-                if timestamp == last:
-                    # Put in test the last (user,item) that has interaction without impression
-                    testItems.append(str(user) + " " + str(item)+ "\n")
-                    break  # Since we don't care about interactions after the last
-                else:
-                    trainItems.append(str(user) + " " + str(item)+ "\n")
-
-        # Remove duplicates
-        trainItems = set(trainItems)
-        testItems = set(testItems)
-
-        testFile.writelines(item for item in testItems)
-        trainFile.writelines(item for item in trainItems)
-        trainFile.close()
-        testFile.close()
+        if strategy not in SPLIT_STRATEGIES:
+            raise ValueError("unknown split strategy %s, expected one of %s" % (strategy, SPLIT_STRATEGIES))
+        if strategy == 'time_cutoff' and cutoff is None:
+            raise ValueError("time_cutoff split needs a cutoff timestamp")
+
+        db = self.interactions
+        # like a user -> timestamp table, keep one event per timestamp
+        latest = numpy.flatnonzero(db.last_per_timestamp())
+        users = db.user_positions()[latest]
+        options = {'strategy': strategy, 'n': n, 'cutoff': cutoff}
+
+        # cut the events in n_jobs even parts, moving every cut to the closest bound of its user
+        cuts = numpy.linspace(0, len(latest), n_jobs + 1)[1:-1].astype(numpy.int64)
+        bounds = cuts
+        if len(latest):
+            starts = numpy.searchsorted(users, users[cuts], side='left')
+            ends = numpy.searchsorted(users, users[cuts], side='right')
+            bounds = numpy.where(cuts - starts <= ends - cuts, starts, ends)
+        bounds = numpy.r_[0, bounds, len(latest)]
+        shards = [
+            (users[start:stop], db.user_ids, db.item[latest[start:stop]],
+             db.interaction[latest[start:stop]], db.timestamp[latest[start:stop]], options)
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+        ]
+        if n_jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+                results = list(executor.map(_split_shard, shards))
+        else:
+            results = [_split_shard(shard) for shard in shards]
+
+        # shards hold disjoint users so their rows are already unique
+        empty = numpy.zeros((0, 2), dtype=numpy.int64)
+        trainItems = numpy.concatenate([train for train, test in results] + [empty])
+        testItems = numpy.concatenate([test for train, test in results] + [empty])
+        numpy.savetxt(train_filename, trainItems, fmt='%d %d')
+        numpy.savetxt(test_filename, testItems, fmt='%d %d')
+        print("split %d train and %d test (user, item) pairs" % (len(trainItems), len(testItems)))
 
 
 if __name__ == '__main__':
@@ -246,19 +298,18 @@ if __name__ == '__main__':
     parser.add_argument('testFileName', help='path of test data file')
     parser.add_argument('evaluationsLib', help='path of evaluations files lib')
     # add_argument('split', help='should program split input to train/test files [yes/no]')
+    parser.add_argument('--splitStrategy', default='last_click', choices=SPLIT_STRATEGIES, help='how to pick the test interactions of every user')
+    parser.add_argument('--splitN', type=int, default=1, help='number of test interactions per user for the last_n split')
+    parser.add_argument('--splitCutoff', type=int, help='first test timestamp for the time_cutoff split')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes to split the data with')
 
     args = parser.parse_args()
 
-    f = open(args.inFile, 'r')
-    lines = f.read()
-    f.close()
-    lines = lines.splitlines()
-
     # Parse data and init the databases
-    recSys = RecSys(lines)
+    recSys = RecSys(args.inFile)
 
     # We shall split data to train and test if we're ordered to by arguments
-    recSys.splitData(args.trainFileName, args.testFileName)
+    recSys.splitData(args.trainFileName, args.testFileName, args.splitStrategy, args.splitN, args.splitCutoff, args.jobs)
 
     # run BPR and bring evaluations of results using several methods
     #os.system('python testTheano.py ' + args.trainFileName + ' ' + args.testFileName)
@@ -271,5 +322,6 @@ if __name__ == '__main__':
 
     recSys.calculate_cosine_similarity()
     recSys.calculate_pierson_similarity()
+    recSys.calculate_spearman_similarity()
 
 
@@ -3,56 +3,48 @@ import sys
 import argparse
 import numpy
 
+from interaction_store import read_chunks
 
 #sys.argv[1] if sys.argv[1] is not None else
 
 parser = argparse.ArgumentParser()
 parser.add_argument('inFile', help='an absolute path input file with "user item interaction" pattern')
 parser.add_argument('outFile', help='an absolute path output file with dictionary')
+parser.add_argument('--chunkSize', type=int, default=1000000, help='number of lines parsed at a time')
 args = parser.parse_args()
 print(args.inFile)
 print(args.outFile)
 
-f = open(args.inFile, 'r')
-lines = f.read()
-f.close()
-lines = lines.splitlines()
 
-count = 0
-myDict = {}
-for line in lines:
-    count+=1
+def reduce_pairs(users, items, masks):
+    '''
+    Merges the interaction bit masks of repeated (user, item) pairs
+    :return: users, items and masks of the unique pairs
+    '''
+    order = numpy.lexsort((items, users))
+    users, items, masks = users[order], items[order], masks[order]
+    starts = numpy.flatnonzero(numpy.r_[True, (users[1:] != users[:-1]) | (items[1:] != items[:-1])])
+    return users[starts], items[starts], numpy.bitwise_or.reduceat(masks, starts)
 
-    #skip header
-    if count is 1:
-        continue
 
-    tokens = line.split()
-    key, interaction = tokens[0] + ' ' + tokens[1], int(tokens[2])
+# every (user, item) pair keeps a bit mask of the interactions seen on it
+pairs = []
+for chunk in read_chunks(args.inFile, args.chunkSize, usecols=(0, 1, 2)):
+    masks = numpy.left_shift(1, chunk[:, 2]).astype(numpy.int64)
+    pairs.append(reduce_pairs(chunk[:, 0], chunk[:, 1], masks))
 
-    if key in myDict.keys():
-        print("already seen this key")
-    else:
-        myDict[line] = {}
-
-    myDict[line][interaction] = 1
-
-    if count%1000 == 0:
-        print(count)
+if pairs:
+    users, items, masks = reduce_pairs(*[numpy.concatenate(column) for column in zip(*pairs)])
+else:
+    users = items = masks = numpy.zeros(0, dtype=numpy.int64)
 
 print('woohhoo')
 
 desired_action = {2,3,5}
-count = 0
-for key,value in myDict.items():
-    count += 1
-    if set(desired_action).issubset(value):
-        myDict[key] = 1
-    else:
-        myDict[key] = 0
-
-    if count%1000 == 0:
-        print(count)
+desired_mask = sum(1 << action for action in desired_action)
+matches = (masks & desired_mask) == desired_mask
+
+myDict = {str(user) + ' ' + str(item): int(match) for user, item, match in zip(users.tolist(), items.tolist(), matches.tolist())}
 
 numpy.save(args.outFile, myDict)
 print('done')
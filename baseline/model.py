@@ -5,29 +5,61 @@ the recsys challenge 2017.
 by Daniel Kohlsdorf
 '''
 
-class User:
-    def __init__(self, title, clevel, indus, disc, country, region):
-        self.title   = title
-        self.clevel  = clevel
-        self.indus   = indus
-        self.disc    = disc
-        self.country = country
-        self.region  = region
-
-class Item:
-    def __init__(self, title, clevel, indus, disc, country, region):
-        self.title   = title
-        self.clevel  = clevel
-        self.indus   = indus
-        self.disc    = disc
-        self.country = country
-        self.region  = region
+import numpy as np
+from scipy import sparse
+
+class Row:
+    '''
+    Lightweight view of the row of a user or item in its AttributeTable,
+    holding no data of its own
+    '''
+    __slots__ = ('table', 'row')
+    def __init__(self, table, row):
+        self.table = table
+        self.row   = row
+    @property
+    def title(self):
+        t = self.table
+        return t.title_indices[t.title_indptr[self.row]:t.title_indptr[self.row + 1]].tolist()
+    @property
+    def clevel(self):
+        return int(self.table.clevel[self.row])
+    @property
+    def indus(self):
+        return int(self.table.indus[self.row])
+    @property
+    def disc(self):
+        return int(self.table.disc[self.row])
+    @property
+    def country(self):
+        return str(self.table.country[self.row])
+    @property
+    def region(self):
+        return str(self.table.region[self.row])
+
+class User(Row):
+    __slots__ = ()
+
+class Item(Row):
+    __slots__ = ()
 
 class Interaction:
+    '''
+    An interaction only keeps the tables and the rows of its user and item
+    '''
+    __slots__ = ('users', 'items', 'user_row', 'item_row', 'interaction_type')
     def __init__(self, user, item, interaction_type):
-        self.user = user
-        self.item = item
+        self.users    = user.table
+        self.items    = item.table
+        self.user_row = user.row
+        self.item_row = item.row
         self.interaction_type = interaction_type
+    @property
+    def user(self):
+        return self.users.row_class(self.users, self.user_row)
+    @property
+    def item(self):
+        return self.items.row_class(self.items, self.item_row)
     def title_match(self):
         return float(len(set(self.user.title).intersection(set(self.item.title))))
     def clevel_match(self):
@@ -66,4 +98,152 @@ class Interaction:
         else:
             return 1.0
 
+class AttributeTable:
+    '''
+    Columnar encoding of a dict of users or items by id: row k
+    holds the attributes of ids[k] (ids are sorted), and the titles
+    (the job roles of users) are a CSR matrix given by
+    title_indptr and title_indices, with no repeated value per row.
+    '''
+    COLUMNS = ('ids', 'title_indptr', 'title_indices', 'clevel', 'indus', 'disc', 'country', 'region')
+
+    def __init__(self, ids, title_indptr, title_indices, clevel, indus, disc, country, region):
+        self.ids           = np.asarray(ids, dtype=np.int64)
+        self.title_indptr  = np.asarray(title_indptr, dtype=np.int64)
+        self.title_indices = np.asarray(title_indices, dtype=np.int32)
+        self.clevel        = np.asarray(clevel, dtype=np.int32)
+        self.indus         = np.asarray(indus, dtype=np.int32)
+        self.disc          = np.asarray(disc, dtype=np.int32)
+        self.country       = np.asarray(country, dtype=str)
+        self.region        = np.asarray(region, dtype=str)
+
+    @classmethod
+    def from_columns(cls, columns):
+        return cls(*[columns[name] for name in cls.COLUMNS])
+
+    def columns(self):
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    def __len__(self):
+        return len(self.ids)
+
+    # read only dict interface from id to row view
+    row_class = Row
+
+    def __getitem__(self, id):
+        row = self.rows([id])[0]
+        if row < 0:
+            raise KeyError(id)
+        return self.row_class(self, row)
+
+    def __contains__(self, id):
+        return self.rows([id])[0] >= 0
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def rows(self, ids):
+        '''
+        positions of ids in the table, -1 for the unknown ones
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return np.where(self.ids[pos] == ids, pos, -1)
+
+    def title_width(self):
+        return int(self.title_indices.max()) + 1 if len(self.title_indices) else 0
+
+    def title_matrix(self, n_columns=None):
+        if n_columns is None:
+            n_columns = self.title_width()
+        return sparse.csr_matrix(
+            (np.ones(len(self.title_indices), dtype=np.float32), self.title_indices, self.title_indptr),
+            shape=(len(self.ids), n_columns)
+        )
+
+class UserTable(AttributeTable):
+    row_class = User
+
+class ItemTable(AttributeTable):
+    row_class = Item
+
+def pair_features(users, items, user_rows, item_rows, block_size=1000000, title_matches=None):
+    '''
+    Interaction.features() of every (user_rows[k], item_rows[k]) pair
+    of rows of the user and item AttributeTables, as an N x 6 array.
+    title_matches can pass the title matches when they are already known.
+    '''
+    user_rows = np.asarray(user_rows, dtype=np.int64)
+    item_rows = np.asarray(item_rows, dtype=np.int64)
+    if title_matches is None:
+        width = max(users.title_width(), items.title_width())
+        user_titles = users.title_matrix(width)
+        item_titles = items.title_matrix(width)
+    data = np.empty((len(user_rows), 6), dtype=np.float32)
+    for start in range(0, len(user_rows), block_size):
+        u = user_rows[start:start + block_size]
+        i = item_rows[start:start + block_size]
+        block = data[start:start + len(u)]
+        # titles are binary, so the row-wise product counts the shared values
+        if title_matches is None:
+            block[:, 0] = np.asarray(user_titles[u].multiply(item_titles[i]).sum(axis=1)).ravel()
+        else:
+            block[:, 0] = title_matches[start:start + len(u)]
+        block[:, 1] = users.clevel[u] == items.clevel[i]
+        block[:, 2] = users.indus[u] == items.indus[i]
+        block[:, 3] = 2.0 * (users.disc[u] == items.disc[i])
+        block[:, 4] = users.country[u] == items.country[i]
+        block[:, 5] = users.region[u] == items.region[i]
+    return data
+
+def pair_labels(interaction_types):
+    '''
+    Interaction.label() of every interaction type
+    '''
+    return np.where(np.asarray(interaction_types) == 4, 0.0, 1.0)
+
+class CandidateIndex:
+    '''
+    Inverted index from title value to the users (among user_rows of
+    the user AttributeTable) holding it as a job role. The users with
+    a title_match above 0 with an item are found from the postings of
+    the item title values only, instead of scanning every user.
+    '''
+    def __init__(self, users, user_rows):
+        self.user_rows = np.asarray(user_rows, dtype=np.int64)
+        self.width = users.title_width()
+        # row v holds the users with the title value v
+        self.postings = users.title_matrix(self.width)[self.user_rows].T.tocsr()
+
+    @classmethod
+    def from_columns(cls, columns):
+        index = cls.__new__(cls)
+        index.user_rows = columns['user_rows']
+        index.width = len(columns['indptr']) - 1
+        index.postings = sparse.csr_matrix(
+            (columns['data'], columns['indices'], columns['indptr']), shape=(index.width, len(index.user_rows))
+        )
+        return index
+
+    def columns(self):
+        return {
+            'user_rows': self.user_rows, 'indptr': self.postings.indptr,
+            'indices': self.postings.indices, 'data': self.postings.data
+        }
 
+    def candidates(self, items, item_rows):
+        '''
+        candidate users of every row in item_rows of the item AttributeTable,
+        as a CSR triple: the users of item_rows[k] are user_rows[indptr[k]:indptr[k + 1]]
+        with their title_match in title_matches[indptr[k]:indptr[k + 1]]
+        '''
+        item_titles = items.title_matrix(max(items.title_width(), self.width))[np.asarray(item_rows, dtype=np.int64)]
+        # title values beyond self.width have no users
+        product = item_titles[:, :self.width].dot(self.postings).tocsr()
+        product.sort_indices()
+        return product.indptr.astype(np.int64), self.user_rows[product.indices], product.data
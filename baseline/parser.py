@@ -5,7 +5,30 @@ items and user models.
 by Daniel Kohlsdorf
 '''
 
-from model import *
+import itertools
+import os
+import sys
+import numpy as np
+from scipy import sparse
+
+# the binary cache and the field splitting are shared with interaction_store one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from interaction_store import load_cached_arrays, split_fields
+
+CACHE_DIR     = "parsed_cache"
+CHUNK_SIZE    = 1000000
+
+# columns of the challenge files and how to parse them: 'int', 'str'
+# or 'list' for comma separated ints, stored as CSR <name>.indptr/<name>.indices
+USER_COLUMNS = {
+    'id': 'int', 'jobroles': 'list', 'career_level': 'int', 'industry_id': 'int',
+    'discipline_id': 'int', 'country': 'str', 'region': 'str'
+}
+ITEM_COLUMNS = {
+    'id': 'int', 'title': 'list', 'career_level': 'int', 'industry_id': 'int',
+    'discipline_id': 'int', 'country': 'str', 'region': 'str'
+}
+INTERACTION_COLUMNS = {'user_id': 'int', 'item_id': 'int', 'interaction_type': 'int'}
 
 def is_header(line):
     return "recsyschallenge" in line 
@@ -16,53 +39,115 @@ def process_header(header):
         x[name.split(".")[1]] = pos
         pos += 1
     return x
-def select(from_file, where, toObject, index):    
-    header = None
-    data = {}
+def read_columns(from_file, columns, chunk_size=CHUNK_SIZE):
+    '''
+    Parses the columns of from_file named in the dict columns
+    (see USER_COLUMNS) chunk_size lines at a time into typed arrays,
+    without building an object per line.
+    '''
+    parsed = {name: [] for name in columns}
     i = 0
-    for line in open(from_file):
-        if is_header(line):
-            header = process_header(line.strip().split("\t"))
-        else:
-            cmp = line.strip().split("\t")
-            if where(cmp):
-                obj = toObject(cmp, header)
-                if obj != None:
-                    data[index(cmp)] = obj
-        i += 1
-        if i % 100000 == 0:
+    with open(from_file) as f:
+        header = next(f, "")
+        if not is_header(header):
+            raise ValueError("no recsyschallenge header in " + from_file)
+        header = process_header(header.strip().split("\t"))
+        n_fields = len(header)
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            fields = split_fields(lines, n_fields)
+            for name, kind in columns.items():
+                values = fields[header[name]::n_fields]
+                if kind == 'int':
+                    parsed[name].append(parse_ints(values))
+                elif kind == 'str':
+                    parsed[name].append(np.array(values, dtype=str))
+                else:
+                    parsed[name].append(split_lists(values))
+            i += len(lines)
             print("... reading line " + str(i) + " from file " + from_file)
-    return(header, data)        
-def build_user(str_user, names):
-    return User(
-        [int(x) for x in str_user[names["jobroles"]].split(",") if len(x) > 0],
-        int(str_user[names["career_level"]]),
-        int(str_user[names["industry_id"]]),
-        int(str_user[names["discipline_id"]]),
-        str_user[names["country"]],
-        str_user[names["region"]]
-    )
-def build_item(str_item, names):
-    return Item(
-        [int(x) for x in str_item[names["title"]].split(",") if len(x) > 0],
-        int(str_item[names["career_level"]]),
-        int(str_item[names["industry_id"]]),
-        int(str_item[names["discipline_id"]]),
-        str_item[names["country"]],
-        str_item[names["region"]]
-    )
-class InteractionBuilder:    
-    def __init__(self, user_dict, item_dict):
-        self.user_dict = user_dict
-        self.item_dict = item_dict   
-    def build_interaction(self, str_inter, names):
-        if int(str_inter[names['item_id']]) in self.item_dict and int(str_inter[names['user_id']]) in self.user_dict:
-            return Interaction(
-                self.user_dict[int(str_inter[names['user_id']])],
-                self.item_dict[int(str_inter[names['item_id']])],
-                int(str_inter[names["interaction_type"]])
-            )
+    data = {}
+    for name, kind in columns.items():
+        if kind == 'int':
+            data[name] = np.concatenate(parsed[name] + [np.zeros(0, dtype=np.int64)])
+        elif kind == 'str':
+            data[name] = np.concatenate(parsed[name] + [np.zeros(0, dtype=str)])
         else:
-            return None
-
-
+            counts = np.concatenate([c for c, _ in parsed[name]] + [np.zeros(0, dtype=np.int64)])
+            data[name + ".indptr"] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+            data[name + ".indices"] = np.concatenate([x for _, x in parsed[name]] + [np.zeros(0, dtype=np.int64)])
+    return data
+def parse_ints(values, sep=" "):
+    '''
+    int64 array of a list of integer strings, parsed in one numpy call
+    '''
+    ints = np.fromstring(sep.join(values), dtype=np.int64, sep=sep) if values else np.zeros(0, dtype=np.int64)
+    if len(ints) != len(values):
+        raise ValueError("invalid integer in " + repr(values[:10]) + "...")
+    return ints
+def split_lists(values):
+    '''
+    number of ints of every comma separated int list of values, and all the ints
+    '''
+    counts = np.array([x.count(",") + 1 if x else 0 for x in values], dtype=np.int64)
+    ints = np.fromstring(" ".join(values).replace(",", " "), dtype=np.int64, sep=" ") if values else np.zeros(0, dtype=np.int64)
+    if len(ints) != counts.sum():
+        # lists with empty values, such as "1,,2"
+        tokens = [[x for x in value.split(",") if len(x) > 0] for value in values]
+        counts = np.array([len(x) for x in tokens], dtype=np.int64)
+        ints = parse_ints([x for t in tokens for x in t])
+    return counts, ints
+def load_columns(from_file, columns, cache_dir=CACHE_DIR, chunk_size=CHUNK_SIZE):
+    '''
+    read_columns going through the binary cache of interaction_store.load_cached_arrays:
+    the arrays are saved as .npy files in cache_dir and memory mapped on the next runs,
+    as long as from_file is unchanged.
+    '''
+    if cache_dir is None:
+        return read_columns(from_file, columns, chunk_size)
+    return load_cached_arrays(from_file, cache_dir, lambda path: read_columns(path, columns, chunk_size), key=columns)
+def load_table(from_file, columns, table_class, where=None, cache_dir=CACHE_DIR):
+    '''
+    UserTable or ItemTable of from_file, keeping the rows where the vectorized
+    predicate where, on the dict of column arrays, is True. The last line
+    of a repeated id wins.
+    '''
+    data = load_columns(from_file, columns, cache_dir)
+    title = [name for name, kind in columns.items() if kind == 'list'][0]
+    keep = np.ones(len(data["id"]), dtype=bool) if where is None else np.asarray(where(data), dtype=bool)
+    rows = np.flatnonzero(keep)
+    # stable sort by id, then the last row of every id
+    rows = rows[np.argsort(data["id"][rows], kind="stable")]
+    ids = data["id"][rows]
+    rows = rows[np.append(ids[1:] != ids[:-1], True)] if len(rows) else rows
+    indptr = data[title + ".indptr"]
+    titles = sparse.csr_matrix(
+        (np.ones(len(data[title + ".indices"]), dtype=np.float32), data[title + ".indices"], indptr),
+        shape=(len(indptr) - 1, int(data[title + ".indices"].max()) + 1 if len(data[title + ".indices"]) else 0)
+    )[rows]
+    titles.sum_duplicates()
+    return table_class(
+        data["id"][rows], titles.indptr, titles.indices,
+        data["career_level"][rows], data["industry_id"][rows], data["discipline_id"][rows],
+        data["country"][rows], data["region"][rows]
+    )
+def load_interactions(from_file, users, items, where=None, cache_dir=CACHE_DIR):
+    '''
+    The user rows, item rows and interaction types of the interactions of
+    from_file between known users and items where the vectorized predicate
+    where is True, one per (user, item) pair, the last one read.
+    '''
+    data = load_columns(from_file, INTERACTION_COLUMNS, cache_dir)
+    user_rows = users.rows(data["user_id"])
+    item_rows = items.rows(data["item_id"])
+    keep = (user_rows >= 0) & (item_rows >= 0)
+    if where is not None:
+        keep &= np.asarray(where(data), dtype=bool)
+    rows = np.flatnonzero(keep)
+    keys = user_rows[rows] * len(items) + item_rows[rows]
+    order = np.argsort(keys, kind="stable")
+    rows, keys = rows[order], keys[order]
+    rows = rows[np.append(keys[1:] != keys[:-1], True)] if len(rows) else rows
+    return user_rows[rows], item_rows[rows], np.asarray(data["interaction_type"][rows])
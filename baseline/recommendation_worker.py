@@ -6,59 +6,147 @@ by Daniel Kohlsdorf
 from model import *
 import xgboost as xgb
 import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
 
 TH = 0.8
+TOP_N = 99
+# number of target items whose candidate pairs are scored in one predict call
+BATCH_ITEMS = 100
+# number of target items handed to a worker at a time
+CHUNK_ITEMS = 100
 
-def classify_worker(item_ids, target_users, items, users, output_file, model):
-    with open(output_file, 'w') as fp:
-        pos = 0
-        average_score = 0.0
-        num_evaluated = 0.0
-        for i in item_ids:
-            data = []        
-            ids  = []
+def top_users(scores, threshold=TH, n=TOP_N):
+    '''
+    positions of the n best scores above threshold, best first,
+    ties kept in position order like a stable sort
+    '''
+    best = np.flatnonzero(scores > threshold)
+    if len(best) > n:
+        kth = -np.partition(-scores[best], n - 1)[n - 1]
+        above = best[scores[best] > kth]
+        best = np.sort(np.concatenate((above, best[scores[best] == kth][:n - len(above)])))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+def classify_items(item_ids, user_table, item_table, index, fp, model, batch_items=BATCH_ITEMS):
+    '''
+    writes the recommendations of item_ids to fp and returns
+    the sum and the number of the scores predicted
+    '''
+    score_sum = 0.0
+    num_evaluated = 0.0
+    for pos in range(0, len(item_ids), batch_items):
+        batch = np.asarray(item_ids[pos:pos + batch_items], dtype=np.int64)
+        item_rows = item_table.rows(batch)
+        batch, item_rows = batch[item_rows >= 0], item_rows[item_rows >= 0]
+
+        # build the (user, item) pair features of the candidate users of all
+        # the items of the batch, the target users with a title match
+        indptr, user_rows, title_matches = index.candidates(item_table, item_rows)
+        if len(user_rows) > 0:
+            data = pair_features(
+                user_table, item_table, user_rows, np.repeat(item_rows, np.diff(indptr)), title_matches=title_matches
+            )
 
-            # build all (user, item) pair features based for this item
-            for u in target_users:        
-                x = Interaction(users[u], items[i], -1)
-                if x.title_match() > 0:
-                    f = x.features()
-                    data += [f]
-                    ids  += [u]
+            # predictions from XGBoost, one call for the whole batch
+            ypred = model.predict(xgb.DMatrix(data))
 
-            if len(data) > 0:
-                # predictions from XGBoost
-                dtest = xgb.DMatrix(np.array(data))
-                ypred = model.predict(dtest)
+            # compute average score
+            score_sum += float(ypred.sum())
+            num_evaluated += float(len(ypred))
 
-                # compute average score
-                average_score += sum(ypred)
-                num_evaluated += float(len(ypred))
+            # use the best users with a score above the given threshold and write the results to file
+            for k, i in enumerate(batch):
+                best = top_users(ypred[indptr[k]:indptr[k + 1]])
+                if len(best) > 0:
+                    user_ids = user_table.ids[user_rows[indptr[k] + best]]
+                    fp.write(str(i) + "\t" + ",".join(str(u) for u in user_ids) + "\n")
+            fp.flush()
+    return score_sum, num_evaluated
 
-                # use all items with a score above the given threshold and sort the result
-                user_ids = sorted(
-                    [
-                        (ids_j, ypred_j) for ypred_j, ids_j in zip(ypred, ids) if ypred_j > TH
-                    ],
-                    key = lambda x: -x[1]
-                )[0:99]                                                        
+def share_arrays(arrays):
+    '''
+    copies every array of the dict arrays into its own shared memory
+    segment and returns the segments and the spec to attach them
+    '''
+    segments = []
+    spec = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        segments.append(segment)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+        spec[name] = (segment.name, array.shape, array.dtype.str)
+    return segments, spec
 
-                # write the results to file
-                if len(user_ids) > 0:            
-                    item_id = str(i) + "\t"
-                    fp.write(item_id)
-                    for j in range(0, len(user_ids)):
-                        user_id = str(user_ids[j][0]) + ","
-                        fp.write(user_id)
-                    user_id = str(user_ids[-1][0]) + "\n"
-                    fp.flush()
+def attach_arrays(spec):
+    '''
+    maps the segments of a spec from share_arrays back to arrays, without copying
+    '''
+    segments = []
+    arrays = {}
+    for name, (segment_name, shape, dtype) in spec.items():
+        segment = shared_memory.SharedMemory(name=segment_name)
+        segments.append(segment)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    return segments, arrays
+
+def shared_worker(spec, model_file, queue, output_file):
+    '''
+    attaches to the shared user, item and candidate index columns, loads
+    the model from model_file and classifies the chunks of target items
+    pulled from queue until it gets None
+    '''
+    segments, arrays = attach_arrays(spec)
+    columns = lambda prefix: {name.split(".", 1)[1]: a for name, a in arrays.items() if name.startswith(prefix + ".")}
+    user_table = AttributeTable.from_columns(columns("users"))
+    item_table = AttributeTable.from_columns(columns("items"))
+    index = CandidateIndex.from_columns(columns("index"))
+    model = xgb.Booster(model_file=model_file)
+    done = 0
+    average_score = 0.0
+    num_evaluated = 0.0
+    with open(output_file, 'w') as fp:
+        for item_ids in iter(queue.get, None):
+            score_sum, n = classify_items(item_ids, user_table, item_table, index, fp, model)
+            average_score += score_sum
+            num_evaluated += n
+            done += len(item_ids)
+            # After every chunk print some stats
+            try:
+                score = str(average_score / num_evaluated)
+            except ZeroDivisionError:
+                score = 0
+            print(output_file + " " + str(done) + " " + str(score))
+    del user_table, item_table, index, arrays
+    for segment in segments:
+        segment.close()
 
-            # Every 100 iterations print some stats
-            if pos % 100 == 0:
-                try:
-                    score = str(average_score / num_evaluated)
-                except ZeroDivisionError:
-                    score = 0
-                percentageDown = str(pos / float(len(item_ids)))
-                print(output_file + " " + percentageDown + " " + score)
-            pos += 1        
+def run_workers(target_items, user_table, item_table, index, model_file, n_workers, chunk_items=CHUNK_ITEMS):
+    '''
+    classifies target_items with n_workers processes writing to solution_<k>.csv.
+    The tables and the index live once in shared memory, and the workers pull
+    chunks of chunk_items items from a queue, so a slow chunk only holds up its worker.
+    '''
+    arrays = {}
+    for prefix, table in (("users", user_table), ("items", item_table), ("index", index)):
+        arrays.update({prefix + "." + name: a for name, a in table.columns().items()})
+    segments, spec = share_arrays(arrays)
+    try:
+        queue = multiprocessing.Queue()
+        for start in range(0, len(target_items), chunk_items):
+            queue.put(list(target_items[start:start + chunk_items]))
+        for _ in range(n_workers):
+            queue.put(None)
+        jobs = [
+            multiprocessing.Process(target = shared_worker, args=(spec, model_file, queue, "solution_" + str(k) + ".csv"))
+            for k in range(n_workers)
+        ]
+        for j in jobs:
+            j.start()
+        for j in jobs:
+            j.join()
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
@@ -0,0 +1,285 @@
+'''
+Columnar storage for the "user item interaction timestamp" usage log.
+
+Every event is kept in four parallel NumPy columns sorted by (user, timestamp),
+with a CSR-style offset index so that all the events of a user are one
+contiguous slice of each column.
+
+A store can be cached next to its input file as one .npy file per column
+plus a small manifest.json, so a warm start only memory-maps the columns.
+The same cache serves any parser returning a dict of arrays.
+'''
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy
+
+CACHE_VERSION = 2
+COLUMNS = ('user', 'item', 'interaction', 'timestamp', 'user_ids', 'offsets')
+
+
+class InteractionStore:
+    def __init__(self, user, item, interaction, timestamp):
+        '''
+        Builds the store from four parallel columns, in any order.
+        Events are stably sorted by (user, timestamp), so events sharing
+        a timestamp keep the order in which they were read.
+        :param user: user id of every event
+        :param item: item id of every event
+        :param interaction: interaction type of every event
+        :param timestamp: timestamp of every event
+        '''
+        user = numpy.asarray(user, dtype=numpy.int32)
+        item = numpy.asarray(item, dtype=numpy.int32)
+        interaction = numpy.asarray(interaction, dtype=numpy.int8)
+        timestamp = numpy.asarray(timestamp, dtype=numpy.int64)
+
+        # numpy.lexsort is stable and sorts by the last key first
+        order = numpy.lexsort((timestamp, user))
+        self.user = user[order]
+        self.item = item[order]
+        self.interaction = interaction[order]
+        self.timestamp = timestamp[order]
+        self._build_index()
+
+    @classmethod
+    def from_file(cls, path, chunk_size=1000000):
+        '''
+        Parses a file with the pattern 'user item interaction timestamp' (and a header line)
+        chunk by chunk, so only one chunk of text is held in memory at a time.
+        '''
+        columns = ([], [], [], [])
+        for chunk in read_chunks(path, chunk_size, usecols=(0, 1, 2, 3)):
+            for column, dtype, values in zip(columns, (numpy.int32, numpy.int32, numpy.int8, numpy.int64), chunk.T):
+                column.append(values.astype(dtype))
+        return cls(*[numpy.concatenate(column) if column else numpy.zeros(0) for column in columns])
+
+    def _build_index(self):
+        '''
+        user_ids[k] is the k-th user and its events are
+        offsets[k]:offsets[k + 1] in every column.
+        '''
+        boundaries = numpy.flatnonzero(self.user[1:] != self.user[:-1]) + 1
+        starts = numpy.concatenate(([0], boundaries)) if len(self.user) else numpy.zeros(0, dtype=numpy.int64)
+        self.user_ids = self.user[starts]
+        self.offsets = numpy.append(starts, len(self.user)).astype(numpy.int64)
+
+    def __len__(self):
+        return len(self.user)
+
+    @property
+    def n_users(self):
+        return len(self.user_ids)
+
+    def user_slice(self, k):
+        '''
+        :return: slice over the columns holding the events of the k-th user
+        '''
+        return slice(self.offsets[k], self.offsets[k + 1])
+
+    def user_index(self, user):
+        '''
+        :return: position of `user` in user_ids, or -1 if it has no events
+        '''
+        k = numpy.searchsorted(self.user_ids, user)
+        if k < len(self.user_ids) and self.user_ids[k] == user:
+            return int(k)
+        return -1
+
+    def user_events(self, user):
+        '''
+        :return: (item, interaction, timestamp) views of the events of `user`, ordered by timestamp
+        '''
+        k = self.user_index(user)
+        if k < 0:
+            s = slice(0, 0)
+        else:
+            s = self.user_slice(k)
+        return self.item[s], self.interaction[s], self.timestamp[s]
+
+    def user_positions(self):
+        '''
+        :return: for every event, the position of its user in user_ids
+        '''
+        return numpy.repeat(numpy.arange(self.n_users), numpy.diff(self.offsets))
+
+    def pair_masks(self):
+        '''
+        Reduces the events to unique (user, item) pairs, ORing the interaction
+        types seen on every pair into a bit mask (bit t set for interaction type t).
+        :return: user positions, item ids and bit masks of the pairs, sorted by (user, item)
+        '''
+        users = self.user_positions()
+        order = numpy.lexsort((self.item, users))
+        users = users[order]
+        items = self.item[order]
+        masks = numpy.left_shift(1, self.interaction[order].astype(numpy.int64))
+        if len(order) == 0:
+            return users, items, masks
+        starts = numpy.flatnonzero(numpy.r_[True, (users[1:] != users[:-1]) | (items[1:] != items[:-1])])
+        return users[starts], items[starts], numpy.bitwise_or.reduceat(masks, starts)
+
+    def last_per_timestamp(self):
+        '''
+        A user can have several events on the same timestamp.
+        :return: boolean mask keeping only the last one read for every (user, timestamp)
+        '''
+        mask = numpy.ones(len(self), dtype=bool)
+        mask[:-1] = (self.user[1:] != self.user[:-1]) | (self.timestamp[1:] != self.timestamp[:-1])
+        return mask
+
+    def save(self, directory):
+        '''
+        Writes every column to `directory` as a .npy file.
+        '''
+        save_arrays(directory, self.columns())
+
+    def columns(self):
+        '''
+        :return: dict of the columns of the store, by name
+        '''
+        return {name: getattr(self, name) for name in COLUMNS}
+
+    @classmethod
+    def from_columns(cls, columns):
+        '''
+        Wraps columns returned by columns(), already sorted and indexed, without copying them.
+        '''
+        store = cls.__new__(cls)
+        for name in COLUMNS:
+            setattr(store, name, columns[name])
+        return store
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        '''
+        Loads a store written by save(). With the default `mmap_mode` the
+        columns are memory-mapped instead of read into memory.
+        '''
+        return cls.from_columns({name: numpy.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in COLUMNS})
+
+def read_chunks(path, chunk_size=1000000, usecols=None, skip_header=True):
+    '''
+    Reads a whitespace separated file of integers by chunks of `chunk_size` lines.
+    Reports progress in rows/sec as it goes.
+    :return: generator of int64 arrays of shape (rows, columns)
+    '''
+    rows = 0
+    start = time.time()
+    with open(path, 'r') as f:
+        if skip_header:
+            next(f, None)
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            chunk = numpy.loadtxt(lines, dtype=numpy.int64, usecols=usecols, ndmin=2)
+            rows += len(chunk)
+            elapsed = time.time() - start
+            print("%s: read %d rows (%.0f rows/sec)" % (path, rows, rows / elapsed if elapsed > 0 else 0))
+            yield chunk
+
+
+def split_fields(lines, n_fields):
+    '''
+    Splits tab separated `lines` into one flat list of `n_fields` fields per line,
+    so field f of every line is fields[f::n_fields], in a single split when every
+    line has exactly `n_fields` fields. Otherwise the lines are split one by one,
+    padding missing trailing fields with '' and cutting extra ones.
+    '''
+    if not lines:
+        return []
+    if all(line.count('\t') == n_fields - 1 for line in lines):
+        text = ''.join(lines).replace('\r', '')
+        if not text.endswith('\n'):
+            text += '\n'
+        return text[:-1].replace('\n', '\t').split('\t')
+    fields = []
+    for line in lines:
+        values = line.rstrip('\r\n').split('\t')
+        fields += values[:n_fields] + [''] * (n_fields - len(values))
+    return fields
+
+
+def file_signature(path):
+    '''
+    :return: the (path, size, mtime) part of the cache key of `path`
+    '''
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def file_hash(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_directory(path, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(path).encode('utf8')).hexdigest()[:16])
+
+
+def save_arrays(directory, arrays):
+    '''
+    Writes every array of the dict `arrays` to `directory` as <name>.npy.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        numpy.save(os.path.join(directory, name + '.npy'), array)
+
+
+def load_cached_arrays(path, cache_dir, build, key=None):
+    '''
+    Returns the dict of named arrays parsed from `path`, going through a cache in `cache_dir`.
+    The cache is keyed on the path, size, mtime and SHA-1 of the input file and on `key`.
+    When size and mtime are unchanged the cached arrays are memory-mapped straight away;
+    otherwise the content hash decides whether the cache is still valid.
+    :param build: function that parses `path` into a dict of arrays on a cache miss
+    :param key: JSON serializable parsing options, the cache is only used when they match
+    '''
+    directory = cache_directory(path, cache_dir)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    signature = file_signature(path)
+    manifest = None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    if manifest is not None and manifest.get('version') == CACHE_VERSION and manifest['path'] == signature['path'] and manifest['key'] == key:
+        fresh = manifest['size'] == signature['size'] and manifest['mtime'] == signature['mtime']
+        if not fresh and manifest['size'] == signature['size'] and manifest['sha1'] == file_hash(path):
+            # only touched, remember the new mtime so the next start skips hashing
+            manifest.update(signature)
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+            fresh = True
+        if fresh:
+            print("Loaded %s from cache %s" % (path, directory))
+            return {name: numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in manifest['arrays']}
+
+    print("No valid cache for %s in %s, parsing it" % (path, cache_dir))
+    arrays = build(path)
+    # drop the manifest first so a half written cache is never trusted
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    save_arrays(directory, arrays)
+    manifest = dict(signature, version=CACHE_VERSION, sha1=file_hash(path), key=key, arrays=sorted(arrays))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return arrays
+
+
+def load_cached(path, cache_dir, build):
+    '''
+    Returns the InteractionStore parsed from `path`, going through the cache of
+    load_cached_arrays() in `cache_dir`.
+    :param build: function that parses `path` into an InteractionStore on a cache miss
+    '''
+    return InteractionStore.from_columns(load_cached_arrays(path, cache_dir, lambda path: build(path).columns()))
@@ -0,0 +1,133 @@
+# theano-bpr
+#
+# Copyright (c) 2014 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy
+import time
+
+class IVFIndex(object):
+
+    def __init__(self, h, b, n_lists=None, n_iter=10, block_size=65536):
+        """
+          Creates an inverted file (IVF) index over the item factors
+          `h` and item biases `b` of a trained BPR model, for
+          approximate top-k search of the scores w.h^T + b.
+
+          Maximum inner product search is turned into nearest
+          neighbour search by indexing the augmented item vectors
+
+            x = [h, b, sqrt(M^2 - |[h, b]|^2)]
+
+          where M is the largest norm of [h, b], and querying with
+          [w, 1, 0]: the closest items to the query are the ones
+          with the highest score.
+
+          Items are clustered in `n_lists` lists (by default the
+          square root of the number of items) with `n_iter`
+          iterations of k-means.
+        """
+        h = numpy.asarray(h, dtype='float32')
+        b = numpy.asarray(b, dtype='float32')
+        n_items = len(h)
+        if n_lists is None:
+            n_lists = max(1, int(numpy.sqrt(n_items)))
+        n_lists = min(n_lists, n_items)
+        x = numpy.column_stack((h, b))
+        norms = (x ** 2).sum(axis=1)
+        x = numpy.column_stack((x, numpy.sqrt(norms.max() - norms)))
+        self._block_size = block_size
+
+        centroids = x[numpy.random.choice(n_items, n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = self._assign(x, centroids)
+            counts = numpy.bincount(assignment, minlength=n_lists)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, x)
+            # empty lists keep their previous centroid
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        assignment = self._assign(x, centroids)
+
+        self.centroids = centroids
+        self.list_items = numpy.argsort(assignment, kind='stable')
+        self.list_indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(assignment, minlength=n_lists))))
+        self._h = h
+        self._b = b
+
+    def _assign(self, x, centroids):
+        """
+          Returns the index of the closest centroid of each row of `x`.
+        """
+        half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+        assignment = numpy.empty(len(x), dtype='int64')
+        for start in range(0, len(x), self._block_size):
+            block = x[start:start + self._block_size]
+            assignment[start:start + len(block)] = numpy.argmax(block.dot(centroids.T) - half_norms, axis=1)
+        return assignment
+
+    def search(self, w, topn=10, n_probe=1, seen=None):
+        """
+          Returns a (len(`w`), `topn`) array of the approximate top
+          items for each user factor row of `w`, best first, padded
+          with -1 when fewer than `topn` candidates are found.
+
+          `n_probe` is the number of lists scanned for each user:
+          higher values give a better recall at a higher latency.
+
+          `seen` is an optional scipy.sparse CSR matrix with a row per
+          row of `w`, holding the items to leave out of the results.
+        """
+        w = numpy.atleast_2d(w)
+        n_probe = min(n_probe, len(self.centroids))
+        half_norms = 0.5 * (self.centroids ** 2).sum(axis=1)
+        # the query [w, 1, 0] is closest to the centroids maximising q.c - |c|^2 / 2
+        centroid_scores = w.dot(self.centroids[:, :-2].T) + self.centroids[:, -2] - half_norms
+        probes = numpy.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+        top = numpy.full((len(w), topn), -1, dtype='int64')
+        for row, lists in enumerate(probes):
+            candidates = numpy.concatenate([self.list_items[self.list_indptr[l]:self.list_indptr[l + 1]] for l in lists])
+            if seen is not None:
+                candidates = candidates[~numpy.isin(candidates, seen.indices[seen.indptr[row]:seen.indptr[row + 1]])]
+            scores = self._h[candidates].dot(w[row]) + self._b[candidates]
+            k = min(topn, len(candidates))
+            if k == 0:
+                continue
+            best = numpy.argpartition(-scores, k - 1)[:k]
+            top[row, :k] = candidates[best[numpy.argsort(-scores[best], kind='stable')]]
+        return top
+
+def benchmark(model, user_indices, topn=10, n_probes=(1, 2, 4, 8, 16)):
+    """
+      Compares the approximate top predictions of the index built
+      on `model` (see `BaseBPR.build_index`) with the exact ones for
+      `user_indices`, for each number of probed lists in `n_probes`.
+
+      Returns a list of (n_probe, recall, seconds per user) tuples,
+      where n_probe is None for the exact search.
+    """
+    user_indices = numpy.asarray(user_indices, dtype='int64')
+    t0 = time.time()
+    exact = model.top_predictions_batch(user_indices, topn)
+    results = [(None, 1.0, (time.time() - t0) / len(user_indices))]
+    print("exact: %.6f seconds per user" % results[0][2])
+    for n_probe in n_probes:
+        t0 = time.time()
+        approximate = model.top_predictions_batch(user_indices, topn, n_probe=n_probe)
+        elapsed = (time.time() - t0) / len(user_indices)
+        hits = sum(len(numpy.intersect1d(e[e >= 0], a[a >= 0])) for e, a in zip(exact, approximate))
+        recall = hits / float(max(1, (exact >= 0).sum()))
+        results.append((n_probe, recall, elapsed))
+        print("n_probe=%d: recall@%d %.4f, %.6f seconds per user" % (n_probe, topn, recall, elapsed))
+    return results
@@ -0,0 +1,500 @@
+# theano-bpr
+#
+# Copyright (c) 2014 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy
+import json
+import os
+import time
+import sys
+import queue
+import threading
+from scipy import sparse
+from theano_bpr.ann import IVFIndex
+from theano_bpr.evaluation import evaluate
+from theano_bpr.item_features import ItemFeatures
+from theano_bpr.utils import save_evaluation
+
+MODEL_VERSION = 1
+
+class BaseBPR(object):
+
+    def __init__(self, rank, n_users, n_items, lambda_u = 0.0025, lambda_i = 0.0025, lambda_j = 0.00025, lambda_bias = 0.0, learning_rate = 0.05):
+        """
+          Backend independent part of a Bayesian Personalised Ranking
+          (BPR) Matrix Factorisation model: sampling, training loop,
+          predictions and evaluation.
+
+          Subclasses hold the W, H and B factors, return them as NumPy
+          arrays from `_factors` and implement `train_model`, which runs
+          one iteration of gradient descent on a batch of (user,
+          positive item, negative item) samples.
+
+          See `theano_bpr.bpr.BPR` for the meaning of the parameters.
+        """
+        self._rank = rank
+        self._n_users = n_users
+        self._n_items = n_items
+        self._lambda_u = lambda_u
+        self._lambda_i = lambda_i
+        self._lambda_j = lambda_j
+        self._lambda_bias = lambda_bias
+        self._learning_rate = learning_rate
+        self._train_matrix_cache = None
+        self._index = None
+        self._new_batch_size = 0
+
+    def _factors(self):
+        """
+          Returns the W, H and B factors as NumPy arrays.
+        """
+        raise NotImplementedError
+
+    def _set_factors(self, w, h, b):
+        """
+          Replaces the W, H and B factors by the given arrays.
+        """
+        raise NotImplementedError
+
+    def train_model(self, u, i, j):
+        """
+          Runs one iteration of gradient descent for the batch of
+          samples (u[k], i[k], j[k]) and returns its cost.
+        """
+        raise NotImplementedError
+
+    def save(self, path, users_to_i=None, items_to_i=None):
+        """
+          Saves the model in the directory `path`: the W, H and B
+          factors and the positive items of the training set as .npy
+          files, the user and item identifiers of `users_to_i` and
+          `items_to_i` (as returned by `load_data_from_csv`) ordered
+          by index, and the hyperparameters in model.json.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, factor in zip(('W', 'H', 'B'), self._factors()):
+            numpy.save(os.path.join(path, name + '.npy'), numpy.asarray(factor))
+        numpy.save(os.path.join(path, 'train_indptr.npy'), self._train_indptr)
+        numpy.save(os.path.join(path, 'train_indices.npy'), self._train_indices)
+        numpy.save(os.path.join(path, 'train_keys.npy'), self._train_keys)
+        numpy.save(os.path.join(path, 'train_users.npy'), self._train_users_array)
+        for name, mapping in (('users', users_to_i), ('items', items_to_i)):
+            if mapping is not None:
+                ids = sorted(mapping, key=mapping.get)
+                numpy.save(os.path.join(path, name + '.npy'), numpy.array([str(x) for x in ids]))
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            json.dump({
+                'version': MODEL_VERSION,
+                'backend': type(self).__name__,
+                'rank': self._rank,
+                'n_users': self._n_users,
+                'n_items': self._n_items,
+                'lambda_u': self._lambda_u,
+                'lambda_i': self._lambda_i,
+                'lambda_j': self._lambda_j,
+                'lambda_bias': self._lambda_bias,
+                'learning_rate': self._learning_rate,
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+          Loads a model saved by `save` from the directory `path`.
+          The factors are memory-mapped with `mmap_mode` ('r' by
+          default, so processes scoring with the same model share
+          its pages; use None to load them in memory for training).
+          The saved format doesn't depend on the backend. Only
+          `theano_bpr.numpy_bpr.NumpyBPR` keeps the mapped pages:
+          the Theano `BPR` compiles its graph and copies the factors
+          into its shared variables, so use `NumpyBPR.load` to only
+          score with a model.
+
+          This function will return the model, the mapping from
+          user ids to integers and the mapping from item ids to
+          integers (None when they were not saved).
+        """
+        with open(os.path.join(path, 'model.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != MODEL_VERSION:
+            raise ValueError("%s holds a version %s model, expected version %s" % (path, meta['version'], MODEL_VERSION))
+        model = cls(meta['rank'], meta['n_users'], meta['n_items'], meta['lambda_u'], meta['lambda_i'], meta['lambda_j'], meta['lambda_bias'], meta['learning_rate'])
+        model._set_factors(*[numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in ('W', 'H', 'B')])
+        model._set_train_index(*[
+            numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) if os.path.exists(os.path.join(path, name + '.npy')) else None
+            for name in ('train_indptr', 'train_indices', 'train_keys', 'train_users')
+        ])
+        mappings = []
+        for name in ('users', 'items'):
+            ids_path = os.path.join(path, name + '.npy')
+            mappings.append({x: i for i, x in enumerate(numpy.load(ids_path).tolist())} if os.path.exists(ids_path) else None)
+        return model, mappings[0], mappings[1]
+
+    def train(self, train_data, epochs=30, batch_size=1000, prefetch=2, init_model=None, new_data=None, new_weight=0.5, n_samples=None):
+        """
+          Trains the BPR Matrix Factorisation model using Stochastic
+          Gradient Descent and minibatches over `train_data`.
+
+          `train_data` is an array of (user_index, item_index) tuples,
+          or an (n, 2) integer array as returned by
+          `load_arrays_from_csv`.
+
+          We draw `epochs` * size of `train_data` random samples from
+          `train_data` for training, one batch of length `batch_size`
+          at a time, and run one iteration of gradient descent for
+          each batch. Only the batches in flight are held in memory.
+          The cost of a batch is linear in `batch_size`, so large
+          batches (100k and more) are fine.
+
+          `prefetch` is the number of batches sampled ahead on a
+          background thread while the current batch trains. With a
+          `prefetch` of 0 batches are sampled in the training loop.
+          Errors raised while sampling are raised by `train`.
+
+          For incremental training, `init_model` is a previously
+          trained model whose users and items are the first ones of
+          this model (as when extending its `users_to_i` and
+          `items_to_i` mappings with `load_data_from_array`): its
+          factors are copied over and only new users and items start
+          from a random initialisation. `new_data` is the part of
+          `train_data` made of new (user_index, item_index) events,
+          and a `new_weight` share of every batch is sampled from it.
+          `n_samples` bounds the number of samples drawn, instead of
+          `epochs` * size of `train_data`.
+        """
+        if len(train_data) < batch_size:
+            sys.stderr.write("WARNING: Batch size is greater than number of training samples, switching to a batch size of %s\n" % str(len(train_data)))
+            batch_size = len(train_data)
+        if init_model is not None:
+            self._warm_start(init_model)
+        self._build_train_index(train_data)
+        self._index = None
+        if new_data is not None and len(new_data) > 0:
+            new_data = self._data_to_array(new_data)
+            self._new_users, self._new_items = new_data[:, 0], new_data[:, 1]
+            self._new_batch_size = int(round(batch_size * new_weight))
+        else:
+            self._new_batch_size = 0
+        n_sgd_samples = len(train_data) * epochs if n_samples is None else n_samples
+        sys.stderr.write("Generating %s random training samples\n" % str(n_sgd_samples))
+        self._train_batches(n_sgd_samples // batch_size, batch_size, prefetch)
+
+    def _warm_start(self, model):
+        """
+          Copies the factors of `model` into the first users and
+          items of this model.
+        """
+        w, h, b = [numpy.array(factor) for factor in self._factors()]
+        old_w, old_h, old_b = model._factors()
+        if len(old_w) > len(w) or len(old_h) > len(h) or old_w.shape[1] != w.shape[1]:
+            raise ValueError("cannot warm start a %dx%d rank %d model from a %dx%d rank %d model" % (
+                len(w), len(h), w.shape[1], len(old_w), len(old_h), old_w.shape[1]))
+        w[:len(old_w)] = old_w
+        h[:len(old_h)] = old_h
+        b[:len(old_b)] = old_b
+        self._set_factors(w, h, b)
+        sys.stderr.write("Warm started from %d users and %d items, %d new users and %d new items\n" % (
+            len(old_w), len(old_h), len(w) - len(old_w), len(h) - len(old_h)))
+
+    def _train_batches(self, n_batches, batch_size, prefetch):
+        """
+          Samples `n_batches` batches of `batch_size` training samples
+          and runs one iteration of gradient descent for each of them
+          with `train_model`.
+        """
+        n_sgd_samples = n_batches * batch_size
+        batches = self._sgd_batches(n_batches, batch_size)
+        if prefetch > 0:
+            batches = self._prefetch(batches, prefetch)
+        z = 0
+        t2 = t1 = t0 = time.time()
+        for sgd_users, sgd_pos_items, sgd_neg_items in batches:
+            self.train_model(sgd_users, sgd_pos_items, sgd_neg_items)
+            z += 1
+            t2 = time.time()
+            sys.stderr.write("\rProcessed %s ( %.2f%% ) in %.4f seconds" %(str(z*batch_size), 100.0 * float(z*batch_size)/n_sgd_samples, t2 - t1))
+            sys.stderr.flush()
+
+    def _sgd_batches(self, n_batches, batch_size):
+        """
+          Yields `n_batches` batches of `batch_size` (user, positive item,
+          negative item) training samples, sampled lazily.
+        """
+        n_new = self._new_batch_size
+        for _ in range(n_batches):
+            if n_new == 0:
+                yield self._uniform_user_sampling(batch_size)
+            else:
+                yield tuple(numpy.concatenate(samples) for samples in zip(
+                    self._uniform_user_sampling(batch_size - n_new), self._new_event_sampling(n_new)))
+
+    def _prefetch(self, batches, size):
+        """
+          Consumes the `batches` iterator on a background thread,
+          keeping at most `size` batches ready ahead of the caller.
+        """
+        ready = queue.Queue(maxsize=size)
+        done = object()
+        failure = []
+
+        def produce():
+            try:
+                for batch in batches:
+                    ready.put(batch)
+            except BaseException as e:
+                # handed over to the consumer, which raises it
+                failure.append(e)
+            finally:
+                ready.put(done)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        while True:
+            batch = ready.get()
+            if batch is done:
+                break
+            yield batch
+        if failure:
+            raise failure[0]
+        producer.join()
+
+    def _build_train_index(self, train_data):
+        """
+          Builds a CSR index of the positive items of every user:
+          the items of user `u` are
+          `_train_indices[_train_indptr[u]:_train_indptr[u+1]]`.
+          `_train_keys` holds the sorted `user * n_items + item`
+          keys of all positive pairs, for bulk membership tests.
+        """
+        data = self._data_to_array(train_data)
+        order = numpy.lexsort((data[:, 1], data[:, 0]))
+        users, items = data[order, 0], data[order, 1]
+        self._set_train_index(numpy.concatenate(([0], numpy.cumsum(numpy.bincount(users, minlength=self._n_users)))), items)
+
+    def _set_train_index(self, indptr, indices, keys=None, users=None):
+        """
+          Sets the CSR index of positive items built by
+          `_build_train_index` and derives the lookups based on it.
+          `keys` and `users` are the saved `_train_keys` and
+          `_train_users_array`; they are only derived from the index
+          when missing. The indices are sorted by user then item, so
+          this never needs to sort.
+        """
+        self._train_indptr = indptr
+        self._train_indices = indices
+        if keys is None:
+            users_of_pairs = numpy.repeat(numpy.arange(len(indptr) - 1), numpy.diff(indptr))
+            keys = users_of_pairs * self._n_items + indices
+            keys = keys[numpy.concatenate(([True], keys[1:] != keys[:-1]))]
+        if users is None:
+            users = numpy.flatnonzero(numpy.diff(indptr))
+        self._train_keys = keys
+        self._train_users_array = users
+        self._train_matrix_cache = None
+
+    @property
+    def _train_matrix(self):
+        """
+          The positive items as a sparse user x item matrix, built
+          on first use on top of `_train_indptr` and `_train_indices`.
+        """
+        if self._train_matrix_cache is None:
+            self._train_matrix_cache = sparse.csr_matrix(
+                (numpy.ones(len(self._train_indices), dtype='int8'), self._train_indices, self._train_indptr),
+                shape=(self._n_users, self._n_items)
+            )
+        return self._train_matrix_cache
+
+    def _is_positive(self, users, items):
+        """
+          Tells for each (user, item) pair whether the item is
+          a positive item of the user in the training data.
+        """
+        keys = users * self._n_items + items
+        found = numpy.searchsorted(self._train_keys, keys)
+        found[found == len(self._train_keys)] = 0
+        return self._train_keys[found] == keys
+
+    def _uniform_user_sampling(self, n_samples):
+        """
+          Creates `n_samples` random samples from training data for performing Stochastic
+          Gradient Descent. We start by uniformly sampling users, 
+          and then sample a positive and a negative item for each 
+          user sample.
+        """
+        sgd_users = self._train_users_array[numpy.random.randint(len(self._train_users_array), size=n_samples)]
+        starts = self._train_indptr[sgd_users]
+        degrees = self._train_indptr[sgd_users + 1] - starts
+        sgd_pos_items = self._train_indices[starts + numpy.random.randint(degrees)]
+        return sgd_users, sgd_pos_items, self._negative_sampling(sgd_users)
+
+    def _new_event_sampling(self, n_samples):
+        """
+          Creates `n_samples` random samples from the new events
+          passed to `train`, with a negative item for each of them.
+        """
+        events = numpy.random.randint(len(self._new_users), size=n_samples)
+        sgd_users = self._new_users[events]
+        return sgd_users, self._new_items[events], self._negative_sampling(sgd_users)
+
+    def _negative_sampling(self, sgd_users):
+        """
+          Samples a negative item for each of `sgd_users`.
+          Negative items are drawn in bulk, and the ones that turn
+          out to be positive are redrawn until none is left.
+        """
+        n_samples = len(sgd_users)
+        sgd_neg_items = numpy.random.randint(self._n_items, size=n_samples)
+        rejected = numpy.flatnonzero(self._is_positive(sgd_users, sgd_neg_items))
+        while len(rejected) > 0:
+            sgd_neg_items[rejected] = numpy.random.randint(self._n_items, size=len(rejected))
+            rejected = rejected[self._is_positive(sgd_users[rejected], sgd_neg_items[rejected])]
+        return sgd_neg_items
+
+    def predictions(self, user_index):
+        """
+          Computes item predictions for `user_index`.
+          Returns an array of prediction values for each item
+          in the dataset.
+        """
+        w, h, b = self._factors()
+        user_vector = w[user_index,:]
+        return user_vector.dot(h.T) + b
+
+    def prediction(self, user_index, item_index):
+        """
+          Predicts the preference of a given `user_index`
+          for a gven `item_index`.
+        """
+        return self.predictions(user_index)[item_index]
+
+    def build_index(self, n_lists=None, n_iter=10):
+        """
+          Builds an approximate nearest neighbour index over the
+          trained item factors and biases, used by `top_predictions`
+          and `top_predictions_batch` when given `n_probe`.
+          See `theano_bpr.ann.IVFIndex` for the parameters.
+          Training the model again drops the index.
+        """
+        w, h, b = self._factors()
+        self._index = IVFIndex(h, b, n_lists, n_iter)
+
+    def top_predictions(self, user_index, topn=10, n_probe=None):
+        """
+          Returns the item indices of the top predictions
+          for `user_index`. The number of predictions to return
+          can be set via `topn`.
+          This won't return any of the items associated with `user_index`
+          in the training set.
+        """
+        return [item_index for item_index in self.top_predictions_batch([user_index], topn, n_probe=n_probe)[0] if item_index >= 0]
+
+    def top_predictions_batch(self, user_indices, topn=10, block_size=1024, n_probe=None):
+        """
+          Returns a (len(`user_indices`), `topn`) array holding, on each
+          row, the item indices of the top predictions for that user,
+          best first. Like `top_predictions` it skips the items
+          associated with the user in the training set; rows are
+          padded with -1 when fewer than `topn` items are left.
+
+          The factors are fetched once, and users are scored by
+          blocks of `block_size` with a single matrix product.
+
+          When `n_probe` is given, the predictions are approximated
+          by scanning `n_probe` lists of the index built by
+          `build_index`: more lists give a better recall but take
+          longer.
+        """
+        w, h, b = self._factors()
+        user_indices = numpy.asarray(user_indices, dtype='int64')
+        if n_probe is not None:
+            if self._index is None:
+                raise ValueError("n_probe needs an index, call build_index after training")
+            return self._index.search(w[user_indices], topn, n_probe, self._train_matrix[user_indices])
+        topn = min(topn, self._n_items)
+        top = numpy.full((len(user_indices), topn), -1, dtype='int64')
+        for start in range(0, len(user_indices), block_size):
+            block = user_indices[start:start + block_size]
+            scores = w[block].dot(h.T) + b
+            seen = self._train_matrix[block]
+            scores[numpy.repeat(numpy.arange(len(block)), numpy.diff(seen.indptr)), seen.indices] = -numpy.inf
+            rows = numpy.arange(len(block))[:, None]
+            candidates = numpy.argpartition(-scores, topn - 1, axis=1)[:, :topn]
+            candidates = candidates[rows, numpy.argsort(-scores[rows, candidates], axis=1, kind='stable')]
+            candidates[numpy.isneginf(scores[rows, candidates])] = -1
+            top[start:start + len(block)] = candidates
+        return top
+
+    def test(self, test_data,items2vec,index_to_items,index_to_users,k,outDir,n_jobs=1):
+        """
+          Evaluates the top `k` predictions on `test_data` and writes
+          the per-user successK, mrrRes, mrrSoftRes, mapSoftRes and
+          ndcgRes metrics to files suffixed by `outDir`, as text and
+          as binary sidecars (see `theano_bpr.utils.save_evaluation`).
+
+          `test_data` is an array of (user_index, item_index) tuples
+          or an (n, 2) integer array, the first test item of each
+          user is the one looked for. Users are written in index
+          order.
+
+          The soft metrics compare items on their features, given
+          either as an `ItemFeatures` object or as the `items2vec`
+          dictionary from item id to features, encoded once here.
+
+          `k` can also be a list of cutoffs, evaluated in one pass;
+          their files are then suffixed by `outDir` followed by k.
+          Users are scored by blocks spread over `n_jobs` processes.
+
+          During this computation we ignore users that didn't appear
+          in the training data, to allow for non-overlapping training
+          and testing sets.
+
+          This function will return the mean of every metric, by k.
+        """
+        single = numpy.isscalar(k)
+        ks = [k] if single else list(k)
+        data = self._data_to_array(test_data)
+        # first test item of every user, in user order
+        data = data[numpy.argsort(data[:, 0], kind='stable')]
+        first = numpy.append(True, data[1:, 0] != data[:-1, 0]) if len(data) else numpy.zeros(0, dtype=bool)
+        users, targets = data[first, 0], data[first, 1]
+        trained = numpy.isin(users, self._train_users_array)
+        users, targets = users[trained], targets[trained]
+
+        if isinstance(items2vec, ItemFeatures):
+            item_features = items2vec
+        else:
+            item_features = ItemFeatures.from_items2vec(items2vec, index_to_items, self._n_items)
+
+        results = evaluate(self, users, targets, ks, item_features.similarity, n_jobs)
+        user_ids = [index_to_users[user] for user in users.tolist()]
+        means = {}
+        for k in ks:
+            suffix = outDir if single else outDir + str(k)
+            for metric, values in results[k].items():
+                with open(metric + suffix, 'w') as f:
+                    f.write("".join("%s\t%s\n" % (user, value) for user, value in zip(user_ids, values.tolist())))
+                if all(str(user).isdigit() for user in user_ids):
+                    save_evaluation(metric + suffix, [int(user) for user in user_ids], values)
+            means[k] = {metric: float(numpy.mean(values)) if len(values) else float('nan') for metric, values in results[k].items()}
+        return means
+
+    def _data_to_array(self, data):
+        """
+          Returns the (user_index, item_index) pairs of `data`, a
+          sequence of tuples or an (n, 2) array, as an int64 array.
+        """
+        if not isinstance(data, numpy.ndarray):
+            data = list(data)
+        return numpy.asarray(data, dtype='int64').reshape(-1, 2)
@@ -0,0 +1,109 @@
+# theano-bpr
+#
+# Copyright (c) 2014 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy
+import multiprocessing
+import sys
+
+METRICS = ('successK', 'mrrRes', 'mrrSoftRes', 'mapSoftRes', 'ndcgRes')
+
+# state of the forked evaluation workers
+_worker_state = None
+
+def evaluate(model, users, targets, ks, soft_similarity=None, n_jobs=1, block_size=1024):
+    """
+      Evaluates the top predictions of `model` for `users` against
+      their test item `targets`, for every cutoff in `ks` at once:
+      the top max(`ks`) items are computed a single time and every
+      metric is derived from that users x topK matrix.
+
+      `soft_similarity` is an optional function mapping a users x
+      topK matrix of item indices (-1 for missing items) and the
+      array of test items to the matrix of their similarities in
+      [0, 1]. It is used by the soft metrics of the users whose
+      test item is not in their top k.
+
+      Users are split in blocks of `block_size` spread over `n_jobs`
+      forked processes.
+
+      This function will return a dictionary mapping each k to a
+      dictionary from metric name (see `METRICS`) to the array of
+      the values of `users` for that metric.
+    """
+    global _worker_state
+    users = numpy.asarray(users, dtype='int64')
+    targets = numpy.asarray(targets, dtype='int64')
+    ks = sorted(ks)
+    blocks = [(start, min(start + block_size, len(users))) for start in range(0, len(users), block_size)]
+    _worker_state = (model, users, targets, ks, soft_similarity)
+    try:
+        if n_jobs > 1:
+            with multiprocessing.get_context('fork').Pool(n_jobs) as pool:
+                results = pool.imap(_evaluate_block, blocks)
+                results = list(_report(results, len(users)))
+        else:
+            results = list(_report(map(_evaluate_block, blocks), len(users)))
+    finally:
+        _worker_state = None
+    return {
+        k: {metric: numpy.concatenate([result[k][metric] for result in results] + [numpy.zeros(0)]) for metric in METRICS}
+        for k in ks
+    }
+
+def _report(results, n_users):
+    done = 0
+    for result in results:
+        done += len(result[min(result)]['successK'])
+        sys.stderr.write("\r" + str(done / float(n_users)))
+        sys.stderr.flush()
+        yield result
+    sys.stderr.write("\n")
+    sys.stderr.flush()
+
+def _evaluate_block(block):
+    model, users, targets, ks, soft_similarity = _worker_state
+    start, stop = block
+    targets = targets[start:stop]
+    top = model.top_predictions_batch(users[start:stop], ks[-1])
+    valid = top >= 0
+    hit = top == targets[:, None]
+    # position of the test item in the top items, or the number of top items if it's not there
+    rank = numpy.where(hit.any(axis=1), hit.argmax(axis=1), top.shape[1])
+    reciprocal_rank = 1.0 / (rank + 1)
+
+    misses = rank >= ks[0]
+    similarity = numpy.zeros(top.shape)
+    if soft_similarity is not None and misses.any():
+        similarity[misses] = soft_similarity(top[misses], targets[misses])
+    similarity[~valid] = 0
+
+    results = {}
+    for k in ks:
+        found = rank < k
+        sims = similarity[:, :k]
+        # soft rank is the first position of the most similar item, when it is similar at all
+        closest = sims.argmax(axis=1)
+        soft_reciprocal_rank = numpy.where(closest > 0, 1.0 / numpy.maximum(closest, 1), 0.0)
+        n_top = numpy.maximum(valid[:, :k].sum(axis=1), 1)
+        soft_average_precision = (sims / numpy.arange(1, sims.shape[1] + 1)).sum(axis=1) / n_top
+        results[k] = {
+            'successK': found.astype('float64'),
+            'mrrRes': numpy.where(found, reciprocal_rank, 0.0),
+            'mrrSoftRes': numpy.where(found, reciprocal_rank, soft_reciprocal_rank),
+            'mapSoftRes': numpy.where(found, reciprocal_rank, soft_average_precision),
+            'ndcgRes': numpy.where(found, 1.0 / numpy.log2(rank + 2), 0.0),
+        }
+    return results
@@ -0,0 +1,205 @@
+# theano-bpr
+#
+# Copyright (c) 2014 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import itertools
+import numpy
+from scipy import sparse
+from interaction_store import load_cached_arrays, split_fields
+
+class ItemFeatures(object):
+
+    def __init__(self, set_features, numeric_features, cache_size=None):
+        """
+          Holds the features of every item index, encoded once:
+
+          `set_features` is a list of binary scipy.sparse CSR matrices
+          with a row per item, one matrix per set valued column (such
+          as title or tags), and `numeric_features` is a dense items x
+          columns matrix of the numerical values.
+
+          The soft similarity of two items is the mean, over all the
+          columns, of the Jaccard index of their sets and of the
+          equality of their numerical values.
+
+          When `cache_size` is given, `pair_similarity` keeps the
+          similarities of the last `cache_size` item pairs in an LRU
+          cache.
+        """
+        self.set_features = [sparse.csr_matrix(features, dtype='float32') for features in set_features]
+        self.numeric_features = numpy.asarray(numeric_features, dtype='float64')
+        self._set_sizes = [numpy.asarray(features.sum(axis=1), dtype='float64').ravel() for features in self.set_features]
+        self._n_columns = len(self.set_features) + self.numeric_features.shape[1]
+        if cache_size is not None:
+            self.pair_similarity = functools.lru_cache(maxsize=cache_size)(self.pair_similarity)
+
+    @classmethod
+    def from_items2vec(cls, items2vec, index_to_items, n_items, cache_size=None):
+        """
+          Encodes `items2vec`, a dictionary from item id to a tuple
+          of the list of sets and the list of numerical values of the
+          item, for the item indices 0 to `n_items` - 1 of
+          `index_to_items`. Items without features get empty sets and
+          zero values.
+        """
+        rows = [items2vec.get(index_to_items.get(index)) for index in range(n_items)]
+        example = next((row for row in rows if row is not None), ([], []))
+        set_features = []
+        for column in range(len(example[0])):
+            sets = [sorted(row[0][column]) if row is not None else [] for row in rows]
+            set_features.append(sets_to_csr(sets))
+        numeric_features = numpy.zeros((n_items, len(example[1])))
+        for index, row in enumerate(rows):
+            if row is not None:
+                numeric_features[index] = row[1]
+        return cls(set_features, numeric_features, cache_size)
+
+    def similarity(self, items, targets):
+        """
+          Returns the soft similarity of each entry of the `items`
+          matrix (of item indices, -1 for no item) with the target
+          item of its row in `targets`, as a matrix of the same shape.
+        """
+        items = numpy.asarray(items, dtype='int64')
+        targets = numpy.asarray(targets, dtype='int64')
+        a = items.ravel()
+        b = numpy.repeat(targets, items.shape[1]) if items.ndim > 1 else targets
+        missing = a < 0
+        a = numpy.where(missing, 0, a)
+        total = (self.numeric_features[a] == self.numeric_features[b]).sum(axis=1).astype('float64')
+        for features, sizes in zip(self.set_features, self._set_sizes):
+            intersection = numpy.asarray(features[a].multiply(features[b]).sum(axis=1), dtype='float64').ravel()
+            union = sizes[a] + sizes[b] - intersection
+            total += numpy.where(union > 0, intersection / numpy.maximum(union, 1), 0)
+        total /= max(self._n_columns, 1)
+        total[missing] = 0
+        return total.reshape(items.shape)
+
+    def pair_similarity(self, first_item, second_item):
+        """
+          Returns the soft similarity of two item indices.
+        """
+        return float(self.similarity([first_item], [second_item])[0])
+
+def sets_to_csr(sets, n_columns=None):
+    """
+      Encodes a list of sets of non-negative integers as a binary
+      CSR matrix with a row per set.
+    """
+    lengths = numpy.array([len(values) for values in sets], dtype='int64')
+    indices = numpy.fromiter((value for values in sets for value in values), dtype='int64', count=int(lengths.sum()))
+    indptr = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    if n_columns is None:
+        n_columns = int(indices.max()) + 1 if len(indices) else 0
+    matrix = sparse.csr_matrix((numpy.ones(len(indices), dtype='float32'), indices, indptr), shape=(len(sets), n_columns))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+def load_items_csv(path, items_to_index, set_columns=(1, 11), numeric_columns=(3, 4), cache_dir='items_cache', cache_size=None, chunk_size=1000000):
+    """
+      Loads the item features of the tab separated file `path`
+      (with a header line and the item id in the first column),
+      aligned to the item indices of `items_to_index`.
+
+      `set_columns` are the columns holding comma separated sets
+      of integers and `numeric_columns` the columns holding a
+      single number, where empty and "null" values read as 0.
+      The file is parsed `chunk_size` lines at a time.
+
+      The parsed columns are cached in `cache_dir` with
+      `interaction_store.load_cached_arrays` and memory-mapped by
+      the next calls, as long as `path` is unchanged. Pass None as
+      `cache_dir` to always parse the file.
+
+      This function will return an `ItemFeatures` with a row per
+      item index; items missing from `path` get empty sets and
+      zero values.
+    """
+    parse = lambda path: _parse_items_csv(path, set_columns, numeric_columns, chunk_size)
+    if cache_dir is None:
+        raw = parse(path)
+    else:
+        raw = load_cached_arrays(path, cache_dir, parse, key={'set_columns': list(set_columns), 'numeric_columns': list(numeric_columns)})
+    ids, numeric = raw['ids'], raw['numeric']
+
+    index_to_items = {index: item for item, index in items_to_index.items()}
+    n_items = max(index_to_items) + 1 if index_to_items else 0
+    index_ids = numpy.array([index_to_items.get(index, '') for index in range(n_items)], dtype=str)
+    positions = numpy.searchsorted(ids, index_ids)
+    found = positions < len(ids)
+    found[found] = ids[positions[found]] == index_ids[found]
+    # maps the parsed rows to the item indices, leaving the missing items empty
+    selection = sparse.csr_matrix((numpy.ones(found.sum(), dtype='float32'), (numpy.flatnonzero(found), positions[found])), shape=(n_items, len(ids)))
+
+    numeric_features = numpy.zeros((n_items, len(numeric_columns)))
+    numeric_features[found] = numeric[positions[found]]
+    set_features = []
+    for k in range(len(set_columns)):
+        indptr, indices = raw['set%d_indptr' % k], raw['set%d_indices' % k]
+        rows = sparse.csr_matrix((numpy.ones(len(indices), dtype='float32'), indices, indptr), shape=(len(ids), int(indices.max()) + 1 if len(indices) else 0))
+        set_features.append(selection.dot(rows).tocsr())
+    return ItemFeatures(set_features, numeric_features, cache_size)
+
+def _parse_items_csv(path, set_columns, numeric_columns, chunk_size):
+    """
+      Parses `path` `chunk_size` lines at a time into the arrays
+      cached by `load_items_csv`: the item ids 'ids' (sorted, the
+      last line wins for repeated ids), the matrix of the numeric
+      columns 'numeric' and a CSR pair 'set<k>_indptr' and
+      'set<k>_indices' per set column.
+    """
+    n_fields = max(list(set_columns) + list(numeric_columns) + [0]) + 1
+    ids, numeric = [], []
+    sets = [([], []) for _ in set_columns]
+    with open(path) as f:
+        next(f, None)
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()]
+            fields = split_fields(lines, n_fields)
+            ids.append(numpy.array(fields[0::n_fields], dtype=str))
+            chunk = numpy.zeros((len(lines), len(numeric_columns)))
+            for k, column in enumerate(numeric_columns):
+                values = numpy.array(fields[column::n_fields], dtype=str)
+                values[(values == '') | (values == 'null')] = '0'
+                chunk[:, k] = values.astype('float64')
+            numeric.append(chunk)
+            for (counts, tokens), column in zip(sets, set_columns):
+                values = fields[column::n_fields]
+                chunk_tokens = numpy.array(','.join(values).split(',') if values else [], dtype=str)
+                token_rows = numpy.repeat(numpy.arange(len(values)), [value.count(',') + 1 for value in values])
+                keep = chunk_tokens != ''
+                counts.append(numpy.bincount(token_rows[keep], minlength=len(values)))
+                tokens.append(chunk_tokens[keep].astype('int64'))
+
+    ids = numpy.concatenate(ids + [numpy.zeros(0, dtype=str)])
+    order = numpy.argsort(ids, kind='stable')
+    last = numpy.append(ids[order][1:] != ids[order][:-1], True) if len(ids) else numpy.zeros(0, dtype=bool)
+    order = order[last]
+    raw = {'ids': ids[order], 'numeric': numpy.concatenate(numeric + [numpy.zeros((0, len(numeric_columns)))])[order]}
+    for k, (counts, tokens) in enumerate(sets):
+        indptr = numpy.concatenate(([0], numpy.cumsum(numpy.concatenate(counts + [numpy.zeros(0, dtype='int64')]))))
+        indices = numpy.concatenate(tokens + [numpy.zeros(0, dtype='int64')])
+        matrix = sparse.csr_matrix(
+            (numpy.ones(len(indices), dtype='float32'), indices, indptr),
+            shape=(len(ids), int(indices.max()) + 1 if len(indices) else 0))[order]
+        matrix.sum_duplicates()
+        raw['set%d_indptr' % k] = matrix.indptr.astype('int64')
+        raw['set%d_indices' % k] = matrix.indices.astype('int64')
+    return raw
@@ -0,0 +1,153 @@
+# theano-bpr
+#
+# Copyright (c) 2014 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from theano_bpr.base import BaseBPR
+
+class NumpyBPR(BaseBPR):
+
+    def __init__(self, rank, n_users, n_items, lambda_u = 0.0025, lambda_i = 0.0025, lambda_j = 0.00025, lambda_bias = 0.0, learning_rate = 0.05, n_workers = 1, worker_type = 'process'):
+        """
+          Creates a new BPR Matrix Factorisation model trained with
+          plain NumPy instead of Theano. It has the same `train`,
+          `predictions`, `top_predictions` and `test` API as
+          `theano_bpr.bpr.BPR` and optimises the same objective,
+          without any graph compilation.
+
+          Each batch only touches the rows of W, H and B of its
+          samples, which are updated in place.
+
+          `n_workers` is the number of workers running SGD at the
+          same time, Hogwild style: every worker samples its own
+          batches and updates the shared factors without locking.
+          `worker_type` is either 'process', where the factors are
+          put in shared memory for the time of the training, or
+          'thread'.
+
+          Example use (10 latent dimensions, 100 users, 50 items,
+          4 worker processes):
+
+          >>> from theano_bpr.numpy_bpr import NumpyBPR
+          >>> bpr = NumpyBPR(10, 100, 50, n_workers=4)
+          >>> from numpy.random import randint
+          >>> train_data = list(zip(randint(100, size=1000), randint(50, size=1000)))
+          >>> bpr.train(train_data)
+        """
+        BaseBPR.__init__(self, rank, n_users, n_items, lambda_u, lambda_i, lambda_j, lambda_bias, learning_rate)
+        if worker_type not in ('process', 'thread'):
+            raise ValueError("worker_type must be 'process' or 'thread', not %s" % worker_type)
+        self._n_workers = n_workers
+        self._worker_type = worker_type
+        self.W = numpy.random.random((self._n_users, self._rank)).astype('float32')
+        self.H = numpy.random.random((self._n_items, self._rank)).astype('float32')
+        self.B = numpy.zeros(self._n_items).astype('float32')
+
+    def _factors(self):
+        return self.W, self.H, self.B
+
+    def _set_factors(self, w, h, b):
+        self.W, self.H, self.B = w, h, b
+
+    def train_model(self, u, i, j):
+        """
+          Runs one iteration of gradient descent on the BPR objective
+          for the batch of samples (u[k], i[k], j[k]), updating only
+          the rows they use, and returns the cost of the batch.
+        """
+        W, H, B = self.W, self.H, self.B
+        w_u, h_i, h_j = W[u], H[i], H[j]
+        x_uij = B[i] - B[j] + (w_u * (h_i - h_j)).sum(axis=1)
+        # derivative of -log(sigmoid(x_uij)) is -sigmoid(-x_uij)
+        z = (1.0 / (1.0 + numpy.exp(x_uij)))[:, None]
+
+        g_w = -z * (h_i - h_j) + 2 * self._lambda_u * w_u
+        g_h_i = -z * w_u + 2 * self._lambda_i * h_i
+        g_h_j = z * w_u + 2 * self._lambda_j * h_j
+        g_b_i = -z[:, 0] + 2 * self._lambda_bias * B[i]
+        g_b_j = z[:, 0] + 2 * self._lambda_bias * B[j]
+
+        numpy.add.at(W, u, -self._learning_rate * g_w)
+        numpy.add.at(H, i, -self._learning_rate * g_h_i)
+        numpy.add.at(H, j, -self._learning_rate * g_h_j)
+        numpy.add.at(B, i, -self._learning_rate * g_b_i)
+        numpy.add.at(B, j, -self._learning_rate * g_b_j)
+
+        return float(numpy.sum(numpy.logaddexp(0, -x_uij))
+            + self._lambda_u * (w_u ** 2).sum() + self._lambda_i * (h_i ** 2).sum() + self._lambda_j * (h_j ** 2).sum()
+            + self._lambda_bias * (B[i] ** 2 + B[j] ** 2).sum())
+
+    def _train_batches(self, n_batches, batch_size, prefetch):
+        """
+          Splits the `n_batches` batches between `n_workers` Hogwild
+          workers. Only the first worker reports its progress.
+        """
+        if self._n_workers <= 1:
+            BaseBPR._train_batches(self, n_batches, batch_size, prefetch)
+            return
+        shares = [n_batches // self._n_workers + (1 if k < n_batches % self._n_workers else 0) for k in range(self._n_workers)]
+        seeds = numpy.random.randint(2 ** 31, size=self._n_workers)
+        if self._worker_type == 'thread':
+            self._run_workers(threading.Thread, shares, seeds, batch_size, prefetch)
+            return
+
+        segments = []
+        try:
+            for name in ('W', 'H', 'B'):
+                factor = getattr(self, name)
+                segment = shared_memory.SharedMemory(create=True, size=max(factor.nbytes, 1))
+                segments.append(segment)
+                shared = numpy.ndarray(factor.shape, dtype=factor.dtype, buffer=segment.buf)
+                shared[...] = factor
+                setattr(self, name, shared)
+            # forked workers inherit the shared mappings of W, H and B
+            self._run_workers(multiprocessing.get_context('fork').Process, shares, seeds, batch_size, prefetch)
+            for name in ('W', 'H', 'B'):
+                setattr(self, name, getattr(self, name).copy())
+        finally:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+
+    def _run_workers(self, worker_class, shares, seeds, batch_size, prefetch):
+        # errors of thread workers, process workers report theirs with their exit code
+        self._worker_errors = []
+        workers = [
+            worker_class(target=self._hogwild_worker, args=(k, share, seed, batch_size, prefetch))
+            for k, (share, seed) in enumerate(zip(shares, seeds))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = sorted(set([k for k, worker in enumerate(workers) if getattr(worker, 'exitcode', 0)] + [k for k, _ in self._worker_errors]))
+        if failed:
+            raise RuntimeError("BPR training workers %s failed" % failed)
+
+    def _hogwild_worker(self, k, n_batches, seed, batch_size, prefetch):
+        if self._worker_type == 'process':
+            numpy.random.seed(seed)
+        try:
+            if k == 0:
+                BaseBPR._train_batches(self, n_batches, batch_size, prefetch)
+            else:
+                for sgd_users, sgd_pos_items, sgd_neg_items in self._sgd_batches(n_batches, batch_size):
+                    self.train_model(sgd_users, sgd_pos_items, sgd_neg_items)
+        except BaseException as e:
+            self._worker_errors.append((k, e))
+            raise
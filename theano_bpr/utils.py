@@ -15,9 +15,11 @@
 # limitations under the License.
 
 from collections import defaultdict
+import itertools
 from urllib import request
+import numpy
 
-def load_data_from_csv(csv, users_to_i = {}, items_to_i = {}):
+def load_data_from_csv(csv, users_to_i = None, items_to_i = None):
     """
       Loads data from a CSV file located at `csv` 
       where each line is of the form:
@@ -28,20 +30,84 @@ def load_data_from_csv(csv, users_to_i = {}, items_to_i = {}):
 
       Initial mappings from user and item identifiers
       to integers can be passed using `users_to_i`
-      and `items_to_i` respectively.
+      and `items_to_i` respectively; they are extended
+      with the new identifiers.
 
       This function will return a data array consisting
       of (user, item) tuples, a mapping from user ids to integers
       and a mapping from item ids to integers.
     """
-    raw_data = []
+    data, users_to_i, items_to_i = load_arrays_from_csv(csv, users_to_i, items_to_i)
+    return list(zip(data[:, 0].tolist(), data[:, 1].tolist())), users_to_i, items_to_i
+
+def load_arrays_from_csv(csv, users_to_i = None, items_to_i = None, chunk_size = None):
+    """
+      Loads data from a CSV file located at `csv` like
+      `load_data_from_csv`, without building a tuple per line.
+
+      When `chunk_size` is given the file is read `chunk_size`
+      lines at a time, so only one chunk of text is held in
+      memory at a time (see `iter_data_from_csv`).
+
+      This function will return an int32 array of shape (n, 2)
+      holding the user and item integers of every line, a mapping
+      from user ids to integers and a mapping from item ids to
+      integers.
+    """
+    users_to_i = {} if users_to_i is None else users_to_i
+    items_to_i = {} if items_to_i is None else items_to_i
+    if chunk_size is None:
+        with open(csv) as f:
+            chunks = [_map_chunk(f.read(), users_to_i, items_to_i)]
+    else:
+        chunks = [data for data, _, _ in iter_data_from_csv(csv, chunk_size, users_to_i, items_to_i)]
+    return numpy.concatenate(chunks + [numpy.zeros((0, 2), dtype=numpy.int32)]), users_to_i, items_to_i
+
+def iter_data_from_csv(csv, chunk_size = 1000000, users_to_i = None, items_to_i = None):
+    """
+      Reads the CSV file located at `csv` `chunk_size` lines
+      at a time, extending the `users_to_i` and `items_to_i`
+      mappings as new identifiers show up.
+
+      This function will yield, for every chunk, an int32
+      array of shape (n, 2) of its user and item integers
+      along with the mappings as of that chunk.
+    """
+    users_to_i = {} if users_to_i is None else users_to_i
+    items_to_i = {} if items_to_i is None else items_to_i
     with open(csv) as f:
-        for line in f.readlines():
-            user, item = line.strip().split(' ')
-            raw_data.append((user, item))
-    return load_data_from_array(raw_data, users_to_i, items_to_i)
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            yield _map_chunk("".join(lines), users_to_i, items_to_i), users_to_i, items_to_i
+
+def _map_chunk(text, users_to_i, items_to_i):
+    pairs = numpy.array(text.split(), dtype=str).reshape(-1, 2)
+    return numpy.column_stack((map_ids(pairs[:, 0], users_to_i), map_ids(pairs[:, 1], items_to_i)))
+
+def map_ids(ids, ids_to_i):
+    """
+      Maps the identifiers of the array `ids` to integers with
+      `ids_to_i`. Identifiers missing from `ids_to_i` are added
+      to it with the next free integers, in order of first
+      appearance, and the dictionary is only looked up once per
+      distinct identifier.
 
-def load_data_from_movielens(url, threshold, users_to_i = {}, items_to_i = {}):
+      This function will return the int32 array of the integers
+      of `ids`.
+    """
+    unique, first, inverse = numpy.unique(numpy.asarray(ids), return_index=True, return_inverse=True)
+    keys = unique.tolist()
+    i = max(ids_to_i.values()) + 1 if len(ids_to_i) > 0 else 0
+    for k in numpy.argsort(first, kind='stable').tolist():
+        if not keys[k] in ids_to_i:
+            ids_to_i[keys[k]] = i
+            i += 1
+    codes = numpy.array([ids_to_i[key] for key in keys], dtype=numpy.int32)
+    return codes[inverse.ravel()]
+
+def load_data_from_movielens(url, threshold, users_to_i = None, items_to_i = None):
     """
       Loads movielens data from a URL, e.g.
 
@@ -60,9 +126,9 @@ def load_data_from_movielens(url, threshold, users_to_i = {}, items_to_i = {}):
         user, item, rating, timestamp = line.decode('utf8').split('\t')
         if int(rating) > threshold:
             raw_data.append((user, item))
-    return load_data_from_array(raw_data)
+    return load_data_from_array(raw_data, users_to_i, items_to_i)
 
-def load_data_from_array(array, users_to_i = {}, items_to_i = {}):
+def load_data_from_array(array, users_to_i = None, items_to_i = None):
     """
       Loads data from an array of tuples of the form:
 
@@ -70,28 +136,50 @@ def load_data_from_array(array, users_to_i = {}, items_to_i = {}):
 
       Initial mappings from user and item identifiers
       to integers can be passed using `users_to_i`
-      and `items_to_i` respectively.
+      and `items_to_i` respectively; they are extended
+      with the new identifiers.
 
       This function will return a data array consisting
       of (user, item) tuples, a mapping from user ids to integers
       and a mapping from item ids to integers.
     """
-    data = []
-    if len(users_to_i.values()) > 0:
-        u = max(users_to_i.values()) + 1
-    else:
-        u = 0
-    if len(items_to_i.values()) > 0:
-        i = max(items_to_i.values()) + 1
-    else:
-        i = 0
-    for user, item in array:
-        if not user in users_to_i:
-            users_to_i[user] = u
-            u += 1
-        if not item in items_to_i:
-            items_to_i[item] = i
-            i += 1
-        data.append((users_to_i[user], items_to_i[item]))
-    return data, users_to_i, items_to_i
+    users_to_i = {} if users_to_i is None else users_to_i
+    items_to_i = {} if items_to_i is None else items_to_i
+    pairs = list(array)
+    users = map_ids([user for user, _ in pairs], users_to_i)
+    items = map_ids([item for _, item in pairs], items_to_i)
+    return list(zip(users.tolist(), items.tolist())), users_to_i, items_to_i
+
 
+def save_evaluation(path, users, scores):
+    """
+      Saves a per-user evaluation metric in the binary sidecar
+      format read by `load_evaluation`: a `path`.npz file
+      holding a `users` and a `scores` array.
+    """
+    numpy.savez(path + '.npz', users=numpy.asarray(users, dtype=numpy.int64), scores=numpy.asarray(scores, dtype=numpy.float64))
+
+def load_evaluation(path):
+    """
+      Loads a per-user evaluation metric from `path`, either a
+      binary sidecar written by `save_evaluation` (ending in .npz)
+      or a text file where each line is of the form:
+
+        user_id score
+
+      This function will return a sorted array of user ids and
+      the array of their scores. When a user appears more than
+      once, its last score is kept.
+    """
+    if path.endswith('.npz'):
+        with numpy.load(path) as sidecar:
+            users, scores = sidecar['users'], sidecar['scores']
+    else:
+        columns = numpy.loadtxt(path, usecols=(0, 1), ndmin=2)
+        users, scores = columns[:, 0].astype(numpy.int64), columns[:, 1]
+    if len(users) == 0:
+        return users, scores
+    order = numpy.argsort(users, kind='stable')
+    users, scores = users[order], scores[order]
+    last = numpy.append(users[1:] != users[:-1], True)
+    return users[last], scores[last]